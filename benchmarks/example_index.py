@@ -0,0 +1,77 @@
+"""Recall and latency of the example store's approximate index against exact search.
+
+DEFAULT_INDEX in weblm/example_store.py is "ivf", which is exact below IVFIndex.min_rows and approximate above it. Run
+this on data shaped like the real store before relying on it, or before changing nprobe:
+
+    python -m benchmarks.example_index --rows 100000 --noise 1.5 --nprobes 16,32
+
+Vectors are drawn around `clusters` random centers with gaussian `noise`. Low noise gives well-separated clusters, where
+IVF recall is close to 1, and higher noise brings it down.
+"""
+
+import tempfile
+import time
+from typing import Sequence
+
+import fire
+import numpy as np
+
+from weblm.example_store import ExampleStore, write_store
+
+
+def main(rows: int = 100_000,
+         dim: int = 1024,
+         clusters: int = 2000,
+         noise: float = 1.5,
+         queries: int = 200,
+         k: int = 5,
+         nprobes: Sequence[int] = (16, 32),
+         seed: int = 1):
+    """
+    Args:
+        rows (int): examples in the store
+        dim (int): embedding dimension
+        clusters (int): centers the vectors are drawn around
+        noise (float): standard deviation of the vectors around their center
+        queries (int): queries to average over, drawn like the vectors
+        k (int): examples returned per query
+        nprobes (Sequence[int]): IVFIndex.nprobe values to try
+        seed (int): seed for the data
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+
+    def sample(count):
+        return (centers[rng.integers(0, clusters, count)] + noise * rng.normal(size=(count, dim))).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as path:
+        write_store(path, [{"example": str(i)} for i in range(rows)], sample(rows))
+        queries = sample(queries)
+        exact, ivf = ExampleStore(path, index="brute"), ExampleStore(path, index="ivf")
+
+        start = time.time()
+        ivf.nearest(queries[0], k)
+        print(f"ivf training: {time.time() - start:0.2f}s")
+
+        truth, exact_time = [], 0.
+        for query in queries:
+            start = time.time()
+            _, records = exact.nearest(query, k)
+            exact_time += time.time() - start
+            truth.append({r["example"] for r in records})
+        print(f"exact: {exact_time / len(queries) * 1000:0.1f}ms per query")
+
+        for nprobe in ([nprobes] if isinstance(nprobes, int) else nprobes):
+            ivf.index.nprobe = nprobe
+            recall, ivf_time = [], 0.
+            for query, expected in zip(queries, truth):
+                start = time.time()
+                _, records = ivf.nearest(query, k)
+                ivf_time += time.time() - start
+                recall.append(len(expected & {r["example"] for r in records}) / k)
+            print(f"ivf nprobe={nprobe}: {ivf_time / len(queries) * 1000:0.1f}ms per query, "
+                  f"recall@{k} {np.mean(recall):0.3f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
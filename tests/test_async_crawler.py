@@ -0,0 +1,125 @@
+"""Concurrency tests for AsyncCrawler: sessions sharing an event loop must not wait on each other's blocking work, so
+running several of them takes about as long as running one.
+
+`test_simulated_sessions_overlap` runs sessions against simulated pages that serve the snapshot fixtures with a fixed
+latency per browser round-trip, so it runs anywhere. `test_browser_sessions_overlap` drives real pages from
+fixtures/pages and is skipped when no chromium is installed for playwright.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from types import SimpleNamespace
+
+import pytest
+from playwright.async_api import async_playwright
+
+from weblm.browser_pool import BrowserPool
+from weblm.crawler import VIEWPORT_METRICS_JS, AsyncCrawler
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+SESSION_COUNTS = [2, 4, 8]
+NUM_STEPS = 3
+# simulated duration of a single round-trip to the browser
+LATENCY = 0.02
+
+
+class FakePage:
+
+    def __init__(self, metrics):
+        self.url = "file:///fixture.html"
+        self.metrics = metrics
+        self.mouse = SimpleNamespace(click=self._round_trip)
+        self.keyboard = SimpleNamespace(type=self._round_trip, press=self._round_trip)
+
+    async def _round_trip(self, *args, **kwargs):
+        await asyncio.sleep(LATENCY)
+
+    async def evaluate(self, js, arg=None):
+        await self._round_trip()
+        return self.metrics if js == VIEWPORT_METRICS_JS else None
+
+    async def wait_for_load_state(self, state, timeout=None):
+        await self._round_trip()
+
+
+class FakeCDPSession:
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    async def send(self, method, params=None):
+        await asyncio.sleep(LATENCY)
+        return self.snapshot
+
+
+def first_link(elements):
+    return next(e for e in elements if e.startswith("link "))
+
+
+async def simulated_session(fixture):
+    crawler = AsyncCrawler(None, settle="load")
+    crawler.page = FakePage(fixture["metrics"])
+    crawler.client = FakeCDPSession(fixture["snapshot"])
+    crawler._reset_page_state()
+
+    for _ in range(NUM_STEPS):
+        elements = await crawler.crawl()
+        assert elements == fixture["elements"]
+        await crawler.run_cmd("click " + " ".join(first_link(elements).split()[:2]))
+
+
+async def timed_sessions(session, num_sessions, *args):
+    start = time.time()
+    await asyncio.gather(*[session(*args) for _ in range(num_sessions)])
+    return time.time() - start
+
+
+@pytest.mark.parametrize("num_sessions", SESSION_COUNTS)
+def test_simulated_sessions_overlap(num_sessions):
+    with open(os.path.join(FIXTURES, "snapshots", "search_results.json"), "r") as fd:
+        fixture = json.load(fd)
+
+    single = asyncio.run(timed_sessions(simulated_session, 1, fixture))
+    concurrent = asyncio.run(timed_sessions(simulated_session, num_sessions, fixture))
+    assert concurrent < 2 * single
+
+
+async def browser_session(pool):
+    crawler = AsyncCrawler(None, settle="load", pool=pool)
+    await crawler._init_browser()
+    try:
+        await crawler.go_to_page("file://" + os.path.join(FIXTURES, "pages", "index.html"))
+        elements = await crawler.crawl()
+        deals = next(e for e in elements if re.match(r'link \d+ "Deals"', e))
+        await crawler.run_cmd("click " + " ".join(deals.split()[:2]))
+
+        elements = await crawler.crawl()
+        assert any('"First result"' in e for e in elements)
+    finally:
+        await crawler.close()
+
+
+async def browser_sessions(num_sessions):
+    async with async_playwright() as playwright:
+        pool = BrowserPool(playwright, max_browsers=1, max_contexts_per_browser=max(SESSION_COUNTS))
+        try:
+            await pool.warm_up()
+        except Exception as e:
+            pytest.skip(f"chromium is not available: {type(e).__name__}")
+
+        try:
+            # the first session pays for starting up, time the ones after it
+            await browser_session(pool)
+            return await timed_sessions(browser_session, num_sessions, pool)
+        finally:
+            await pool.close()
+
+
+@pytest.mark.parametrize("num_sessions", SESSION_COUNTS)
+def test_browser_sessions_overlap(num_sessions):
+    single = asyncio.run(browser_sessions(1))
+    concurrent = asyncio.run(browser_sessions(num_sessions))
+    assert concurrent < 2 * single
@@ -0,0 +1,41 @@
+"""Golden-file tests for the DOM snapshot walker in Crawler._crawl.
+
+Each fixture in fixtures/snapshots holds a DOMSnapshot.captureSnapshot payload in the shape
+weblm.crawler.SNAPSHOT_PARAMS requests, the viewport metrics it is crawled with, and the elements and click targets the
+original, quadratic walker produced for it. The payloads are hand-built pages (links, forms, selects, ARIA roles, hidden
+and off-screen nodes) and seeded random trees. Payloads recorded from real pages can be added next to them in the same
+format.
+"""
+
+import glob
+import json
+import os
+
+import pytest
+
+from weblm.crawler import Crawler
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "fixtures", "snapshots", "*.json")))
+
+
+def crawl(fixture, vectorized):
+    crawler = Crawler.__new__(Crawler)
+    crawler.vectorized = vectorized
+    crawler.page_element_buffer = {}
+
+    metrics = fixture["metrics"]
+    elements = crawler._crawl(fixture["snapshot"], metrics["pageYOffset"], metrics["screenWidth"],
+                              metrics["pageXOffset"], metrics["screenHeight"], metrics["devicePixelRatio"])
+    centers = {str(k): [v["center_x"], v["center_y"]] for k, v in crawler.page_element_buffer.items()}
+    return elements, centers
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda p: os.path.basename(p)[:-len(".json")])
+def test_crawl_matches_golden(path, vectorized):
+    with open(path, "r") as fd:
+        fixture = json.load(fd)
+
+    elements, centers = crawl(fixture, vectorized)
+    assert elements == fixture["elements"]
+    assert centers == fixture["centers"]
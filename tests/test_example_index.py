@@ -0,0 +1,35 @@
+import numpy as np
+
+from weblm.example_index import BruteForceIndex, IVFIndex
+
+
+def make_vectors(count, dim=16, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+    return vectors, np.linalg.norm(vectors, axis=1)
+
+
+def test_ivf_matches_brute_force_on_its_own_rows():
+    vectors, norms = make_vectors(3000)
+    alive = np.ones(len(vectors), dtype=bool)
+    index = IVFIndex(min_rows=1000, nprobe=1000)
+
+    for query in vectors[:20]:
+        _, expected = BruteForceIndex().search(query, 5, vectors, norms, alive)
+        _, found = index.search(query, 5, vectors, norms, alive)
+        assert list(found) == list(expected)
+
+
+def test_ivf_search_ignores_rows_appended_after_the_view():
+    vectors, norms = make_vectors(3100)
+    index = IVFIndex(min_rows=1000, nprobe=1000)
+    index.search(vectors[0], 5, vectors[:3000], norms[:3000], np.ones(3000, dtype=bool))
+
+    # another thread appends rows and updates the index while a search still holds the view of 3000 rows
+    index.update(vectors, norms)
+    alive = np.ones(3000, dtype=bool)
+    alive[1] = False
+    scores, rows = index.search(vectors[3050], 5, vectors[:3000], norms[:3000], alive)
+
+    assert len(rows) == 5
+    assert rows.max() < 3000
+    assert 1 not in rows
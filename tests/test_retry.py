@@ -0,0 +1,112 @@
+import time
+
+import cohere
+import pytest
+
+from weblm.controllers.basic.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retry, deadline
+
+
+class FakeClient:
+    """Fails the first `failures` requests with a retryable error, then succeeds."""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    def generate(self, prompt):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise cohere.error.CohereError("429 too many requests")
+        return f"generated {prompt}"
+
+
+class FixedPolicy(RetryPolicy):
+
+    def __init__(self, delay: float, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+
+    def backoff(self, attempt):
+        return self.delay
+
+
+def test_retries_until_success():
+    co = FakeClient(failures=2)
+    result = call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=3), breaker=CircuitBreaker())
+    assert result == "generated hi"
+    assert co.calls == 3
+
+
+def test_gives_up_after_max_attempts():
+    co = FakeClient(failures=10)
+    with pytest.raises(cohere.error.CohereError):
+        call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=4), breaker=CircuitBreaker())
+    assert co.calls == 4
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=2.)
+    for attempt in range(1, 10):
+        assert 0 <= policy.backoff(attempt) <= min(2., 0.5 * 2**(attempt - 1))
+
+
+def test_stops_retrying_at_the_deadline():
+    co = FakeClient(failures=10)
+    start = time.time()
+    with deadline(1.), pytest.raises(cohere.error.CohereError):
+        call_with_retry(co.generate, "hi", policy=FixedPolicy(5., max_attempts=10), breaker=CircuitBreaker())
+
+    # the first backoff would already end past the deadline, so it doesn't sleep at all
+    assert co.calls == 1
+    assert time.time() - start < 1.
+
+
+def test_breaker_opens_and_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60.)
+    co = FakeClient(failures=10)
+    for _ in range(3):
+        with pytest.raises(cohere.error.CohereError):
+            call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+    assert breaker.is_open
+
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+    assert co.calls == 3
+
+
+def test_half_open_trial_closes_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    co = FakeClient(failures=2)
+    for _ in range(2):
+        with pytest.raises(cohere.error.CohereError):
+            call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+    assert breaker.is_open
+
+    time.sleep(0.06)
+    assert call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker) == "generated hi"
+    assert not breaker.is_open
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    co = FakeClient(failures=3)
+    for _ in range(2):
+        with pytest.raises(cohere.error.CohereError):
+            call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+
+    time.sleep(0.06)
+    with pytest.raises(cohere.error.CohereError):
+        call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(co.generate, "hi", policy=FixedPolicy(0., max_attempts=1), breaker=breaker)
+    assert co.calls == 3
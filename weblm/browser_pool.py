@@ -0,0 +1,210 @@
+"""A small pool of warm browsers that hands every session its own isolated browser context."""
+
+import asyncio
+import time
+from typing import Dict, List
+
+from .crawler import USER_AGENT
+
+# how often idle browsers are looked for, in seconds
+EVICT_INTERVAL = 30.
+
+
+class BrowserPool:
+    """Keeps a few chromium processes running and hands out one `BrowserContext` per session.
+
+    Contexts are placed on the least loaded browser that still has room. A new browser is only launched when every
+    running browser is at `max_contexts_per_browser`, and once `max_browsers` are running `acquire` waits for a
+    session to end. Browsers that have had no contexts for `idle_timeout` seconds are closed, down to `min_browsers`,
+    by a background task that checks every `EVICT_INTERVAL` seconds.
+
+    Launching a browser and opening or closing a context happen outside the pool's lock. Their slot is reserved
+    first, so sessions waiting on other browsers aren't held up and the limits still hold.
+    """
+
+    def __init__(self,
+                 playwright,
+                 max_browsers: int = 2,
+                 min_browsers: int = 1,
+                 max_contexts_per_browser: int = 8,
+                 idle_timeout: float = 300.,
+                 headless: bool = True):
+        """
+        Args:
+            playwright: an async playwright instance
+            max_browsers (int): the most browser processes to run at once
+            min_browsers (int): browsers to keep warm even when they are idle
+            max_contexts_per_browser (int): the most open contexts (sessions) per browser
+            idle_timeout (float): seconds a browser can sit without contexts before it is closed
+            headless (bool): launch browsers headless
+        """
+        self.playwright = playwright
+        self.max_browsers = max_browsers
+        self.min_browsers = min_browsers
+        self.max_contexts_per_browser = max_contexts_per_browser
+        self.idle_timeout = idle_timeout
+        self.headless = headless
+
+        self._browsers: List = []
+        self._contexts: Dict = {}  # browser -> set of open contexts
+        self._idle_since: Dict = {}  # browser -> time its last context was released
+        self._owners: Dict = {}  # context -> browser
+        self._reserved: Dict = {}  # browser -> contexts being opened on it
+        self._launching = 0  # browsers being launched
+        self._condition = None
+        self._evictor = None
+
+        self.metrics = {"hits": 0, "misses": 0, "waits": 0, "evictions": 0}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self.metrics,
+            "browsers": len(self._browsers),
+            "contexts": len(self._owners),
+        }
+
+    async def acquire(self):
+        """Returns a fresh browser context, launching a browser only if the running ones are full."""
+        self._start()
+
+        async with self._condition:
+            while True:
+                browser = self._least_loaded()
+                if browser is not None:
+                    self.metrics["hits"] += 1
+                    self._reserve(browser)
+                    break
+                elif len(self._browsers) + self._launching < self.max_browsers:
+                    self.metrics["misses"] += 1
+                    self._launching += 1
+                    break
+
+                self.metrics["waits"] += 1
+                await self._condition.wait()
+
+        if browser is None:
+            try:
+                browser = await self.playwright.chromium.launch(headless=self.headless)
+            except BaseException:
+                async with self._condition:
+                    self._launching -= 1
+                    self._condition.notify()
+                raise
+
+            async with self._condition:
+                self._launching -= 1
+                self._add(browser)
+                self._reserve(browser)
+                # the new browser may have room for sessions that are waiting too
+                self._condition.notify_all()
+
+        try:
+            context = await browser.new_context(user_agent=USER_AGENT)
+        except BaseException:
+            async with self._condition:
+                self._unreserve(browser)
+                self._condition.notify()
+            raise
+
+        async with self._condition:
+            self._unreserve(browser)
+            self._contexts[browser].add(context)
+            self._owners[context] = browser
+
+        return context
+
+    async def release(self, context):
+        """Closes a session's context and frees its slot on the browser."""
+        try:
+            await context.close()
+        finally:
+            async with self._condition:
+                browser = self._owners.pop(context, None)
+                if browser is not None:
+                    self._contexts[browser].discard(context)
+                    self._mark_if_idle(browser)
+
+                self._condition.notify()
+
+    async def close(self):
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+
+        for browser in self._browsers:
+            await browser.close()
+
+        self._browsers = []
+        self._contexts = {}
+        self._idle_since = {}
+        self._owners = {}
+        self._reserved = {}
+
+    async def warm_up(self):
+        """Launch `min_browsers` browsers ahead of the first session."""
+        self._start()
+        while len(self._browsers) < self.min_browsers:
+            self._add(await self.playwright.chromium.launch(headless=self.headless))
+
+    def _start(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        if self._evictor is None:
+            self._evictor = asyncio.get_running_loop().create_task(self._evict_periodically())
+
+    def _add(self, browser):
+        self._browsers.append(browser)
+        self._contexts[browser] = set()
+        self._reserved[browser] = 0
+        self._idle_since[browser] = time.time()
+
+    def _reserve(self, browser):
+        self._reserved[browser] += 1
+        self._idle_since.pop(browser, None)
+
+    def _unreserve(self, browser):
+        self._reserved[browser] -= 1
+        self._mark_if_idle(browser)
+
+    def _mark_if_idle(self, browser):
+        if not self._contexts[browser] and not self._reserved[browser]:
+            self._idle_since[browser] = time.time()
+
+    def _load(self, browser) -> int:
+        return len(self._contexts[browser]) + self._reserved[browser]
+
+    def _least_loaded(self):
+        candidates = [b for b in self._browsers if self._load(b) < self.max_contexts_per_browser]
+        if not candidates:
+            return None
+
+        return min(candidates, key=self._load)
+
+    async def _evict_periodically(self):
+        while True:
+            await asyncio.sleep(min(EVICT_INTERVAL, self.idle_timeout))
+            await self._evict_idle()
+
+    async def _evict_idle(self):
+        now = time.time()
+        evicted = []
+        async with self._condition:
+            for browser in list(self._browsers):
+                if len(self._browsers) <= self.min_browsers:
+                    break
+
+                idle_since = self._idle_since.get(browser)
+                if idle_since is not None and now - idle_since > self.idle_timeout:
+                    self._browsers.remove(browser)
+                    del self._contexts[browser]
+                    del self._reserved[browser]
+                    del self._idle_since[browser]
+                    self.metrics["evictions"] += 1
+                    evicted.append(browser)
+
+            if evicted:
+                # room for a new browser, for sessions waiting on max_browsers
+                self._condition.notify_all()
+
+        for browser in evicted:
+            await browser.close()
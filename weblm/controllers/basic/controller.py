@@ -1,19 +1,35 @@
+import asyncio
+import contextvars
 import csv
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-import json
+import functools
 import os
 import re
 from collections import defaultdict
-from typing import DefaultDict, Dict, List, Tuple, Union
+from typing import Any, DefaultDict, Dict, List, Set, Tuple, Union
 
 import cohere
+from weblm.controllers.basic.decision_cache import get_decision_cache
 from weblm.controllers.basic.pick_command import generate_command
-from weblm.controllers.basic.prioritize import generate_prioritization
+from weblm.controllers.basic.prioritize import get_prioritization_cache
 from weblm.controllers.basic.pick_action import pick_action
+from weblm.controllers.basic.retry import STEP_TIMEOUT, deadline
+from weblm.controllers.basic.scheduler import get_scheduler
 from weblm.controllers.basic.utils import (CLICKABLE, MAX_NUM_ELEMENTS, TYPEABLE, DialogueState, construct_state,
-                                           search, shorten_prompt, user_prompt_end, gather_examples)
+                                           ExampleCache, search, shorten_prompt, user_prompt_3, user_prompt_end)
+from weblm.example_store import get_example_store
 from weblm.utils import Command, Prompt, HELP_MSG
 
+# steps fan out into many blocking model calls, this bounds how many run at once across all async sessions
+MAX_CONCURRENT_STEPS = 8
+step_executor = ThreadPoolExecutor(MAX_CONCURRENT_STEPS)
+# generate the command for both clicking and typing while the action is still being picked, then keep the branch of
+# the action that was picked. Lowers the latency of a step at the cost of the losing branch's requests
+SPECULATIVE_EXECUTION = os.environ.get("WEBLM_SPECULATIVE", "").lower() in ("1", "true", "yes")
+# the branches block on the scheduler, so they get threads of their own rather than running on its workers
+speculation_executor = ThreadPoolExecutor(2 * MAX_CONCURRENT_STEPS)
+
 
 class Controller:
     """A Cohere-powered controller that takes in a browser state and produces and action.
@@ -26,17 +42,27 @@ class Controller:
     5. choose what element to click or what element to type in
     """
 
-    def __init__(self, co: cohere.Client, objective: str):
+    def __init__(self, co: cohere.Client, objective: str, speculative: bool = None):
         """
         Args:
             co (cohere.Client): a Cohere Client
             objective (str): the objective to accomplish
+            speculative (bool, optional): generate commands for both actions while picking the action. Defaults to
+                SPECULATIVE_EXECUTION, which is set from the WEBLM_SPECULATIVE environment variable
         """
         self.co = co
         self.objective = objective
+        self.speculative = SPECULATIVE_EXECUTION if speculative is None else speculative
+        self._speculation: Dict[str, Future] = {}
         self.previous_commands: List[str] = []
         self.moments: List[Tuple[str, str, str, List[str]]] = []
         self.user_responses: DefaultDict[str, int] = defaultdict(int)
+        self._step_lock = None
+        # (url, command) pairs offered from the decision cache since the last command was run. They survive
+        # reset_state, so going back or rejecting the command reaches the model instead of the same cached command
+        self._offered_decisions: Set[Tuple[str, str]] = set()
+        # counters for how much work caching saved over the session
+        self.stats: DefaultDict[str, int] = defaultdict(int)
         self.reset_state()
 
     def is_running(self):
@@ -52,44 +78,63 @@ class Controller:
         self._prioritized_elements_hash = None
         self._page_elements = None
         self._error = None
+        # shared by every stage of the step, dropped with the rest of the step's state
+        self._example_cache = ExampleCache(self.stats)
+        self._discard_speculation()
+
+    async def astep(self, url: str, page_elements: List[str], response: str = None) -> Union[Prompt, Command]:
+        """Same as `step`, but runs on a bounded thread pool so it doesn't block the event loop."""
+        return await self._run_in_executor(self.step, url, page_elements, response)
+
+    async def asuccess(self):
+        return await self._run_in_executor(self.success)
+
+    async def _run_in_executor(self, fn, *args):
+        # steps of a single session must not interleave, steps of different sessions run in parallel
+        if self._step_lock is None:
+            self._step_lock = asyncio.Lock()
+
+        async with self._step_lock:
+            return await asyncio.get_running_loop().run_in_executor(step_executor, functools.partial(fn, *args))
 
     def success(self):
-        for url, elements, command, previous_commands in self.moments:
-            self._save_example(objective=self.objective,
-                               url=url,
-                               elements=elements,
-                               command=command,
-                               previous_commands=previous_commands)
+        self._save_examples([
+            self._example_record(self.objective, url, elements, command, previous_commands)
+            for url, elements, command, previous_commands in self.moments
+        ])
 
     def _save_example(self, objective: str, url: str, elements: List[str], command: str, previous_commands: List[str]):
+        self._save_examples([self._example_record(objective, url, elements, command, previous_commands)])
+
+    def _example_record(self, objective: str, url: str, elements: List[str], command: str,
+                        previous_commands: List[str]) -> Dict[str, Any]:
         state = construct_state(objective, url, elements[:MAX_NUM_ELEMENTS], previous_commands)
         example = ("Example:\n"
                    f"{state}\n"
                    f"Next Command: {command}\n"
                    "----")
-        print(f"Example being saved:\n{example}")
-        with open("examples.json", "r") as fd:
-            history = json.load(fd)
-            examples = [h["example"] for h in history]
-
-        if example in examples:
-            print("example already exists")
-            return
-
-        history.append({
+        return {
             "example": example,
-            "embedding": self.co.embed(texts=[example]).embeddings[0],
             "url": url,
             "elements": elements,
             "command": command,
             "previous_commands": previous_commands,
             "objective": objective,
             "datetime": datetime.now().isoformat(),
-        })
+        }
+
+    def _save_examples(self, records: List[Dict[str, Any]]):
+        """Embed the new examples in batched requests and append them to the store in one write."""
+        for record in records:
+            print(f"Example being saved:\n{record['example']}")
 
-        with open("examples_tmp.json", "w") as fd:
-            json.dump(history, fd)
-        os.replace("examples_tmp.json", "examples.json")
+        added = get_example_store().ingest(self.co, records)
+        if added < len(records):
+            print(f"{len(records) - added} examples already exist")
+
+        # saved examples are accepted commands, offer them again when a session reaches the same state
+        for record in records:
+            get_decision_cache().put_record(record)
 
     def _construct_responses(self):
         keys_to_save = ["y", "n", "s", "command", "success", "cancel"]
@@ -120,6 +165,65 @@ class Controller:
                 wr.writerow([self.user_responses[key] for key in keys_to_save])
 
     def step(self, url: str, page_elements: List[str], response: str = None) -> Union[Prompt, Command]:
+        # model requests made during this step are queued under this session so sessions share the scheduler fairly,
+        # and give up retrying once the step has run for STEP_TIMEOUT
+        with get_scheduler().session(id(self)), deadline(STEP_TIMEOUT):
+            return self._take_step(url, page_elements, response)
+
+    def _elements_for_action(self, action: str) -> List[str]:
+        kinds = CLICKABLE if "click" in action else TYPEABLE
+        return list(filter(lambda x: any(x.startswith(y) for y in kinds), self._pruned_prioritized_elements))
+
+    def _use_cached_decision(self, url: str) -> Union[Prompt, None]:
+        """Offer the command accepted before in this state, if there is one, without asking the model."""
+        offered = [cmd for offered_url, cmd in self._offered_decisions if offered_url == url]
+        cmd = get_decision_cache().get(self.objective,
+                                       url,
+                                       self._pruned_prioritized_elements,
+                                       self.previous_commands,
+                                       exclude=offered)
+        if cmd is None:
+            self.stats["decision_misses"] += 1
+            return None
+
+        self.stats["decision_hits"] += 1
+        self._offered_decisions.add((url, cmd))
+        self._action, self._cmd = " " + cmd.split()[0], cmd
+        self._chosen_elements = [{"id": " " + " ".join(cmd.split()[1:3])}]
+        self._step = DialogueState.CommandFeedback
+
+        objective, previous_commands = self.objective, self.previous_commands
+        pruned_elements = self._elements_for_action(self._action)
+        return Prompt(eval(f'f"""{user_prompt_3}"""'))
+
+    def _speculate(self, url: str):
+        """Start generating the command for both actions, to be picked up once the action is known."""
+        if self._speculation or not any(y in x for y in TYPEABLE for x in self._pruned_prioritized_elements):
+            # without typeable elements the action is a click and is picked without asking the model
+            return
+
+        for action in [" click", " type"]:
+            # carries the step's deadline over to the branch's thread
+            context = contextvars.copy_context()
+            self._speculation[action] = speculation_executor.submit(context.run, self._generate_branch, action, url,
+                                                                    self._elements_for_action(action),
+                                                                    self.previous_commands.copy())
+            self.stats["speculation_branches"] += 1
+
+    def _generate_branch(self, action: str, url: str, pruned_elements: List[str], previous_commands: List[str]):
+        # the branch counts into its own stats, which are only merged into the session's if the branch is picked
+        stats = defaultdict(int)
+        with get_scheduler().session(id(self)):
+            return generate_command(self.co, DialogueState.Command, action, None, [], self.objective, url,
+                                    pruned_elements, previous_commands, None, self._example_cache, stats), stats
+
+    def _discard_speculation(self):
+        # a branch that already started runs to completion in the background, its result is just never read
+        for future in self._speculation.values():
+            future.cancel()
+        self._speculation = {}
+
+    def _take_step(self, url: str, page_elements: List[str], response: str = None) -> Union[Prompt, Command]:
         if self._error is not None:
             if response == "c":
                 self._error = None
@@ -138,11 +242,13 @@ class Controller:
             self._page_elements = page_elements
 
             if self._prioritized_elements is None or self._prioritized_elements_hash != hash(frozenset(page_elements)):
-                self._prioritized_elements = generate_prioritization(self.co, self.objective, page_elements, url,
-                                                                     self.previous_commands)
+                self._prioritized_elements = get_prioritization_cache().prioritize(self.co, self.objective,
+                                                                                   page_elements, url,
+                                                                                   self.previous_commands, self.stats)
                 self._prioritized_elements_hash = hash(frozenset(page_elements))
                 self._pruned_prioritized_elements = self._prioritized_elements[:MAX_NUM_ELEMENTS]
                 self._step = DialogueState.Action
+                self._discard_speculation()
 
             if re.match(r'search (.+)', response or ""):
                 query = re.match(r'search (.+)', response).group(1)
@@ -153,24 +259,28 @@ class Controller:
             self.user_responses[response] += 1
             self._construct_responses()
 
+            if self._step == DialogueState.Action:
+                prompt = self._use_cached_decision(url)
+                if prompt is not None:
+                    return prompt
+
+            if self._step == DialogueState.Action and self.speculative:
+                self._speculate(url)
+
             if self._step in [DialogueState.Action, DialogueState.ActionFeedback]:
                 self._step, self._action, prompt = pick_action(self.co, self._step, self._action, self.objective, url,
                                                                self._pruned_prioritized_elements,
-                                                               self.previous_commands, response)
+                                                               self.previous_commands, response,
+                                                               self._example_cache)
 
                 if prompt is not None:
                     return prompt
 
-            if "click" in self._action:
-                pruned_elements = list(
-                    filter(lambda x: any(x.startswith(y) for y in CLICKABLE), self._pruned_prioritized_elements))
-            elif "type" in self._action:
-                pruned_elements = list(
-                    filter(lambda x: any(x.startswith(y) for y in TYPEABLE), self._pruned_prioritized_elements))
+            pruned_elements = self._elements_for_action(self._action)
 
             if response == "prompt":
                 state = construct_state(self.objective, url, self._pruned_prioritized_elements, self.previous_commands)
-                examples = gather_examples(self.co, state)
+                examples = self._example_cache.gather_examples(self.co, state)
                 chosen_element = self._chosen_elements[0]["id"]
                 _, prompt = shorten_prompt(self.co, self.objective, url, pruned_elements, self.previous_commands,
                                            examples, self._action, chosen_element)
@@ -178,11 +288,17 @@ class Controller:
             elif response == "elements":
                 return Prompt("\n".join(str(d) for d in self._chosen_elements))
 
-            self._step, self._cmd, self._chosen_elements, prompt = generate_command(self.co, self._step, self._action,
-                                                                                    self._cmd, self._chosen_elements,
-                                                                                    self.objective, url,
-                                                                                    pruned_elements,
-                                                                                    self.previous_commands, response)
+            speculation = self._speculation.pop(self._action, None) if self._step == DialogueState.Command else None
+            if speculation is not None:
+                self.stats["speculation_hits"] += 1
+                self._discard_speculation()
+                (self._step, self._cmd, self._chosen_elements, prompt), stats = speculation.result()
+                for key, value in stats.items():
+                    self.stats[key] += value
+            else:
+                self._step, self._cmd, self._chosen_elements, prompt = generate_command(
+                    self.co, self._step, self._action, self._cmd, self._chosen_elements, self.objective, url,
+                    pruned_elements, self.previous_commands, response, self._example_cache, self.stats)
             if self._step == DialogueState.CommandFeedback and response == "s":
                 self._save_example(objective=self.objective,
                                    url=url,
@@ -197,6 +313,10 @@ class Controller:
             self.previous_commands.append(self._cmd)
 
             cmd = Command(self._cmd.strip())
+            print(f"Session stats: {dict(self.stats)}")
+            hits, misses = self.stats["prioritization_hits"], self.stats["prioritization_misses"]
+            print(f"Prioritization cache hit rate: {hits / max(1, hits + misses):.0%}")
+            self._offered_decisions.clear()
             self.reset_state()
             return cmd
 
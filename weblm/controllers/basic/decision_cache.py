@@ -0,0 +1,174 @@
+"""A cache of accepted commands, shared by every session in the process.
+
+Users run the same workflows over and over, and every run used to pay for prioritization, action selection and
+element selection again. Whenever an example is saved, its command is remembered for its (normalized) objective, url,
+pruned page elements and previous commands, and a later step in the same state is offered that command without asking
+the model.
+
+Entries expire after a TTL, the least recently used ones are evicted past `max_entries`, and an entry is dropped as
+soon as the example it came from is no longer in the example store (e.g. deleted with history_explorer).
+
+The example store already holds every accepted state and command, so the cache is seeded from it on first use and
+survives restarts, e.g. between runs of weblm.main.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Any, Collection, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from weblm.controllers.basic.utils import MAX_NUM_ELEMENTS
+from weblm.example_store import get_example_store
+
+DECISION_CACHE_SIZE = 4096
+DECISION_TTL = 7 * 24 * 3600.
+
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+
+class DecisionCache:
+
+    def __init__(self, max_entries: int = DECISION_CACHE_SIZE, ttl: float = DECISION_TTL, min_accepts: int = 1):
+        """
+        Args:
+            max_entries (int): the most states to remember, least recently used ones are evicted first
+            ttl (float): seconds after the last time a command was accepted that it is no longer offered
+            min_accepts (int): times a command must have been saved for a state before it is offered
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_accepts = min_accepts
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._seeded = False
+
+        self.metrics = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.metrics, "entries": len(self._entries)}
+
+    @staticmethod
+    def key(objective: str, url: str, elements: List[str], previous_commands: List[str]) -> str:
+        state = [
+            _normalize_text(objective).lower(),
+            _normalize_url(url),
+            sorted(_normalize_text(e) for e in elements),
+            [_normalize_text(c) for c in previous_commands],
+        ]
+        return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+    def get(self,
+            objective: str,
+            url: str,
+            elements: List[str],
+            previous_commands: List[str],
+            exclude: Collection[str] = ()) -> Optional[str]:
+        """The command accepted before in this state, if it is still trusted and not in `exclude` (e.g. because the
+        user already turned it down in this state)."""
+        key = self.key(objective, url, elements, previous_commands)
+        with self._lock:
+            self._seed()
+            entry = self._entries.get(key)
+            if entry is None or entry["accepts"] < self.min_accepts or entry["command"] in exclude:
+                self.metrics["misses"] += 1
+                return None
+
+            if time.time() - entry["accepted_at"] > self.ttl:
+                del self._entries[key]
+                self.metrics["expired"] += 1
+                self.metrics["misses"] += 1
+                return None
+
+        # checked outside the lock, the store may have to reload to see deletions made by other processes
+        target = entry["command"].split()[1:3]
+        if not get_example_store().contains(entry["example"]) or not any(e.split()[:2] == target for e in elements):
+            with self._lock:
+                self._entries.pop(key, None)
+                self.metrics["invalidated"] += 1
+                self.metrics["misses"] += 1
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.metrics["hits"] += 1
+        return entry["command"]
+
+    def put(self,
+            objective: str,
+            url: str,
+            elements: List[str],
+            previous_commands: List[str],
+            command: str,
+            example: str,
+            accepted_at: Optional[float] = None):
+        """Remember that `command` was accepted in this state (at `accepted_at`, defaults to now) and saved as
+        `example`."""
+        key = self.key(objective, url, elements, previous_commands)
+        with self._lock:
+            self._seed()
+            entry = self._entries.get(key)
+            if entry is None or entry["command"] != command:
+                entry = self._entries[key] = {"command": command, "example": example, "accepts": 0}
+
+            entry["accepts"] += 1
+            entry["example"] = example
+            entry["accepted_at"] = time.time() if accepted_at is None else accepted_at
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put_record(self, record: Dict[str, Any], accepted_at: Optional[float] = None):
+        """Remember the command of a saved example record."""
+        self.put(record["objective"],
+                 record["url"],
+                 record["elements"][:MAX_NUM_ELEMENTS],
+                 record["previous_commands"],
+                 record["command"],
+                 record["example"],
+                 accepted_at=accepted_at)
+
+    def _seed(self):
+        if self._seeded:
+            return
+        self._seeded = True
+
+        # only records saved with a timestamp, the TTL can't be applied to the others
+        keys = ["datetime", "objective", "url", "elements", "previous_commands", "command"]
+        seeds = []
+        for record in get_example_store().records:
+            if not all(k in record for k in keys):
+                continue
+
+            try:
+                accepted_at = datetime.fromisoformat(record["datetime"]).timestamp()
+            except (TypeError, ValueError):
+                print(f"Skipping example with malformed datetime {record['datetime']!r}")
+                continue
+
+            if time.time() - accepted_at <= self.ttl:
+                seeds.append((accepted_at, record))
+
+        # oldest first, so the most recently accepted ones are the last to be evicted
+        for accepted_at, record in sorted(seeds, key=lambda s: s[0]):
+            self.put_record(record, accepted_at=accepted_at)
+
+
+_cache = DecisionCache()
+
+
+def get_decision_cache() -> DecisionCache:
+    return _cache
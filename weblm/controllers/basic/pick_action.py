@@ -3,8 +3,8 @@
 from typing import List
 import cohere
 
-from weblm.controllers.basic.utils import (MAX_SEQ_LEN, TYPEABLE, CLICKABLE, DialogueState, choose, construct_prompt,
-                                           construct_state, gather_examples, shorten_prompt, user_prompt_1)
+from weblm.controllers.basic.utils import (MAX_SEQ_LEN, TYPEABLE, CLICKABLE, DialogueState, ExampleCache, choose,
+                                           construct_prompt, construct_state, shorten_prompt, user_prompt_1)
 from weblm.utils import Prompt
 
 
@@ -15,11 +15,12 @@ def pick_action(co: cohere.Client,
                 url: str,
                 page_elements: List[str],
                 previous_commands: List[str],
-                response: str = None):
+                response: str = None,
+                example_cache: ExampleCache = None):
     # this strategy for action selection does not work very well, TODO improve this
 
     state = construct_state(objective, url, page_elements, previous_commands)
-    examples = gather_examples(co, state)
+    examples = (example_cache or ExampleCache()).gather_examples(co, state)
     prompt = construct_prompt(state, examples)
 
     if step == DialogueState.Action:
@@ -4,33 +4,43 @@ import re
 from typing import Dict, List
 import cohere
 
-from weblm.controllers.basic.utils import (MODEL, DialogueState, construct_prompt, construct_state, gather_examples,
-                                           shorten_prompt, truncate_left, user_prompt_2, user_prompt_3, choose_element)
+from weblm.controllers.basic.retry import call_with_retry
+from weblm.controllers.basic.scheduler import estimate_tokens, get_scheduler
+from weblm.controllers.basic.token_counter import get_token_counter
+from weblm.controllers.basic.utils import (MODEL, RANK_SCORING, DialogueState, ExampleCache, construct_prompt,
+                                           construct_state, shorten_prompt, truncate_left, user_prompt_2, user_prompt_3,
+                                           choose_element)
 from weblm.utils import Prompt
 
 
+def _generate_text(co: cohere.Client, action: str, prompt: str, chosen_element: str, num_tokens: int) -> str:
+    counter = get_token_counter()
+    if counter.exceeds(co, prompt, 2048 - num_tokens):
+        print(f"WARNING: truncating sequence of length {counter.count(co, prompt)}")
+        prompt = truncate_left(co.tokenize, prompt, action, chosen_element, limit=2048 - num_tokens)
+
+    print(counter.estimate(prompt + action + chosen_element))
+    return max(co.generate(prompt=prompt + action + chosen_element,
+                           model=MODEL,
+                           temperature=0.5,
+                           num_generations=5,
+                           max_tokens=num_tokens,
+                           stop_sequences=["\n"],
+                           return_likelihoods="GENERATION").generations,
+               key=lambda x: x.likelihood).text
+
+
 def _get_cmd_prediction(co: cohere.Client, action: str, prompt: str, chosen_element: str) -> str:
     if "type" in action:
-        text = None
-        while text is None:
-            try:
-                num_tokens = 20
-                if len(co.tokenize(prompt)) > 2048 - num_tokens:
-                    print(f"WARNING: truncating sequence of length {len(co.tokenize(prompt))}")
-                    prompt = truncate_left(co.tokenize, prompt, action, chosen_element, limit=2048 - num_tokens)
-
-                print(len(co.tokenize(prompt + action + chosen_element)))
-                text = max(co.generate(prompt=prompt + action + chosen_element,
-                                       model=MODEL,
-                                       temperature=0.5,
-                                       num_generations=5,
-                                       max_tokens=num_tokens,
-                                       stop_sequences=["\n"],
-                                       return_likelihoods="GENERATION").generations,
-                           key=lambda x: x.likelihood).text
-            except cohere.error.CohereError as e:
-                print(f"Cohere fucked up: {e}")
-                continue
+        num_tokens = 20
+        text = get_scheduler().submit(call_with_retry,
+                                      _generate_text,
+                                      co,
+                                      action,
+                                      prompt,
+                                      chosen_element,
+                                      num_tokens,
+                                      tokens=estimate_tokens(prompt) + num_tokens).result()
     else:
         text = ""
 
@@ -46,9 +56,11 @@ def generate_command(co: cohere.Client,
                      url: str,
                      pruned_elements: List[str],
                      previous_commands: List[str],
-                     response: str = None):
+                     response: str = None,
+                     example_cache: ExampleCache = None,
+                     stats: Dict[str, int] = None):
     state = construct_state(objective, url, pruned_elements, previous_commands)
-    examples = gather_examples(co, state)
+    examples = (example_cache or ExampleCache()).gather_examples(co, state)
     prompt = construct_prompt(state, examples)
 
     if step == DialogueState.Command:
@@ -70,7 +82,9 @@ def generate_command(co: cohere.Client,
                                                      "elements": x
                                                  }, pruned_elements)),
                                              group_size,
-                                             topk=5)
+                                             topk=5,
+                                             scoring=RANK_SCORING,
+                                             stats=stats)
             chosen_element = chosen_elements[0]["id"]
 
             state = construct_state(objective, url, pruned_elements, previous_commands)
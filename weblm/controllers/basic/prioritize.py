@@ -1,12 +1,19 @@
 """The goal of Prioritization is to sort and filter the elements on a webpage so that the *most relevant* elements to the objective at hand are shown to the model."""
 
-import random
-from typing import List
+from collections import OrderedDict, defaultdict
+import threading
+from typing import Dict, List, Tuple
 import numpy as np
 import cohere
-import json
 
-from weblm.controllers.basic.utils import construct_state, choose
+from weblm.controllers.basic.utils import (RANK_SCORING, construct_prev_cmds, construct_state, choose,
+                                           include_command_element, is_prioritisation_record, retrieve_examples)
+from weblm.example_store import get_example_store
+
+# only this many elements, pre-ranked by embedding similarity, are scored by the LLM. None scores every element
+NUM_PRIORITIZATION_CANDIDATES = 60
+# prioritizations kept by the process-wide PrioritizationCache
+PRIORITIZATION_CACHE_SIZE = 256
 
 prioritization_template = """$examples
 ---
@@ -23,50 +30,51 @@ priorit_tmp = ("Objective: {objective}"
 
 
 def gather_prioritisation_examples(co: cohere.Client, state: str, topk: int = 6, num_elements: int = 3) -> List[str]:
-    """Simple semantic search over a file of past interactions to find the most similar ones."""
-    with open("examples.json", "r") as fd:
-        history = json.load(fd)
-
-    if len(history) == 0:
-        return []
-
-    embeds = [h["embedding"] for h in history]
-    examples = [h["example"] for h in history]
-    embeds = np.array(embeds)
-    embedded_state = np.array(co.embed(texts=[state], truncate="RIGHT").embeddings[0])
-    scores = np.einsum("i,ji->j", embedded_state,
-                       embeds) / (np.linalg.norm(embedded_state) * np.linalg.norm(embeds, axis=1))
-    ind = np.argsort(scores)[-topk:]
-
-    ind = ind.tolist()
-    prioritisation_examples = [None] * len(ind)
-    for i, h in enumerate(history):
-        if i in ind:
-            if all(x in h for x in ["objective", "command", "url", "elements"]):
-                # make sure the element relevant to the next command is included
-                elements = list(filter(lambda x: x[:4] != "text", h["elements"]))
-                command_element = " ".join(h["command"].split()[1:3])
-                command_element = list(filter(lambda x: command_element in x, elements))
-                assert len(command_element) == 1, f"length is {len(command_element)}"
-                command_element = command_element[0]
-
-                if not command_element in elements[:num_elements]:
-                    rand_idx = random.randint(0, num_elements - 1)
-                    elements = elements[:rand_idx] + [command_element] + elements[rand_idx:]
-
-                elements = elements[:num_elements]
-
-                objective = h["objective"]
-                url = h["url"]
-                elements = '\n'.join(elements)
-                prioritisation_example = eval(f'f"""{priorit_tmp}"""')
-                prioritisation_examples[ind.index(i)] = prioritisation_example
-
-    return list(filter(lambda x: x is not None, prioritisation_examples))
-
-
-def generate_prioritization(co: cohere.Client, objective: str, page_elements: List[str], url: str,
-                            previous_commands: List[str]):
+    """Simple semantic search over the store of past interactions to find the most similar ones."""
+    prioritisation_examples = []
+    # least similar first, so the most similar example ends up closest to the prompt
+    for h in reversed(retrieve_examples(co, state, topk, where=is_prioritisation_record)):
+        objective = h["objective"]
+        url = h["url"]
+        elements = '\n'.join(include_command_element(h, num_elements))
+        prioritisation_example = eval(f'f"""{priorit_tmp}"""')
+        prioritisation_examples.append(prioritisation_example)
+
+    return prioritisation_examples
+
+
+def prefilter_elements(co: cohere.Client, objective: str, url: str, page_elements: List[str],
+                       previous_commands: List[str]) -> List[str]:
+    """Cheaply rank `page_elements` by the cosine similarity of their embeddings to the objective, using a single
+    batched embed call."""
+    query = (f"Objective: {objective}"
+             f"\nURL: {url}"
+             f"\nPrevious actions:\n{construct_prev_cmds(previous_commands)}")
+    embeds = get_example_store().embed(co, [query] + page_elements)
+    embedded_query, embedded_elements = embeds[0], embeds[1:]
+    scores = np.einsum("i,ji->j", embedded_query,
+                       embedded_elements) / (np.linalg.norm(embedded_query) * np.linalg.norm(embedded_elements, axis=1))
+    # stable sort so ties keep their page order
+    ind = np.argsort(-scores, kind="stable")
+    return [page_elements[i] for i in ind]
+
+
+def generate_prioritization(co: cohere.Client,
+                            objective: str,
+                            page_elements: List[str],
+                            url: str,
+                            previous_commands: List[str],
+                            num_candidates: int = NUM_PRIORITIZATION_CANDIDATES):
+    """Sort `page_elements` by relevance to the objective.
+
+    On pages with more than `num_candidates` elements, the elements are first ranked by embedding similarity and only
+    the top `num_candidates` are scored by the LLM. The rest follow in embedding order.
+    """
+    remaining_elements = []
+    if num_candidates is not None and len(page_elements) > num_candidates:
+        ranked_elements = prefilter_elements(co, objective, url, page_elements, previous_commands)
+        page_elements, remaining_elements = ranked_elements[:num_candidates], ranked_elements[num_candidates:]
+
     state = construct_state(objective, url, page_elements, previous_commands)
     examples = gather_prioritisation_examples(co, state)
 
@@ -77,7 +85,68 @@ def generate_prioritization(co: cohere.Client, objective: str, page_elements: Li
 
     print(prioritization)
 
-    prioritized_elements = choose(co, prioritization, [{"element": x} for x in page_elements], topk=len(page_elements))
+    prioritized_elements = choose(co,
+                                  prioritization, [{"element": x} for x in page_elements],
+                                  topk=len(page_elements),
+                                  scoring=RANK_SCORING)
     prioritized_elements = [x[1]["element"] for x in prioritized_elements]
 
-    return prioritized_elements
+    return prioritized_elements + remaining_elements
+
+
+class PrioritizationCache:
+    """A bounded LRU of prioritized page elements shared by every session.
+
+    Entries are keyed by the objective, url, set of page elements and previous commands, so going back to a page or
+    re-rendering the same elements reuses the earlier prioritization instead of scoring every element again.
+    """
+
+    def __init__(self, max_entries: int = PRIORITIZATION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, List[str]]" = OrderedDict()
+
+    @staticmethod
+    def key(objective: str, url: str, page_elements: List[str], previous_commands: List[str]) -> Tuple:
+        return (objective, url, hash(frozenset(page_elements)), tuple(previous_commands))
+
+    def prioritize(self,
+                   co: cohere.Client,
+                   objective: str,
+                   page_elements: List[str],
+                   url: str,
+                   previous_commands: List[str],
+                   stats: Dict[str, int] = None) -> List[str]:
+        """`generate_prioritization`, unless the same prioritization is cached.
+
+        Args:
+            stats (Dict[str, int], optional): counters to record "prioritization_hits" and "prioritization_misses" in
+        """
+        stats = stats if stats is not None else defaultdict(int)
+        key = self.key(objective, url, page_elements, previous_commands)
+
+        with self._lock:
+            elements = self._entries.get(key)
+            if elements is not None:
+                self._entries.move_to_end(key)
+
+        if elements is not None:
+            stats["prioritization_hits"] += 1
+            return list(elements)
+
+        stats["prioritization_misses"] += 1
+        elements = generate_prioritization(co, objective, page_elements, url, previous_commands)
+        with self._lock:
+            self._entries[key] = list(elements)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return elements
+
+
+_prioritization_cache = PrioritizationCache()
+
+
+def get_prioritization_cache() -> PrioritizationCache:
+    return _prioritization_cache
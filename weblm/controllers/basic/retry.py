@@ -0,0 +1,133 @@
+"""Retries with exponential backoff for model requests, plus a circuit breaker shared by all of them.
+
+Transient API errors are retried with full-jitter exponential backoff, up to a maximum number of attempts and never
+past the deadline of the step that made the request. When requests keep failing the circuit breaker opens and every
+request fails immediately with `CircuitOpenError`, instead of each one retrying against an unhealthy backend, until a
+trial request succeeds again after `reset_timeout`.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+import cohere
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (cohere.error.CohereError, ConnectionError)
+STEP_TIMEOUT = 300.
+
+# absolute time.time() after which no further retries are attempted, propagated to scheduler workers via contextvars
+_deadline = ContextVar("deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts: int = 6, base_delay: float = 0.5, max_delay: float = 10.):
+        """
+        Args:
+            max_attempts (int): the most times a request is tried, including the first
+            base_delay (float): the backoff cap, in seconds, after the first failure. Doubles with every failure
+            max_delay (float): the largest backoff cap, in seconds
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: a uniformly random delay up to the exponential cap."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**(attempt - 1)))
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int = 8, reset_timeout: float = 30.):
+        """
+        Args:
+            failure_threshold (int): consecutive failures that open the circuit
+            reset_timeout (float): seconds the circuit stays open before a trial request is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            if time.time() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("the model API looks unhealthy, failing fast until it recovers")
+
+            # half-open: let a single trial request through, everything else keeps failing fast until it reports back
+            # (or until another reset_timeout passes without it reporting)
+            self._opened_at = time.time()
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.time()
+                self._trial_in_flight = False
+
+
+default_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Requests made inside this block (including on scheduler workers) stop retrying after `seconds`."""
+    token = _deadline.set(time.time() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def call_with_retry(fn: Callable[..., T],
+                    *args,
+                    policy: RetryPolicy = None,
+                    breaker: CircuitBreaker = None) -> T:
+    policy = policy or default_policy
+    breaker = breaker or circuit_breaker
+    step_deadline = _deadline.get()
+
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = fn(*args)
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            attempt += 1
+            delay = policy.backoff(attempt)
+            if attempt >= policy.max_attempts or (step_deadline is not None and time.time() + delay > step_deadline):
+                raise
+
+            print(f"Model request failed ({e}), retry {attempt} in {delay:0.2f}s")
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
@@ -0,0 +1,178 @@
+"""A process-wide scheduler for model requests.
+
+Every likelihood and generation request made by the basic controller goes through a single pool of worker threads, so
+the number of in-flight requests is capped no matter how many sessions or options there are. Requests are served
+round-robin across sessions so one session scoring hundreds of elements can't starve the others, and can optionally be
+rate limited in requests per second and tokens per minute.
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+MAX_CONCURRENT_REQUESTS = 32
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough, tokenizer-free token count used for rate limiting."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class RateLimiter:
+    """Token buckets for requests per second and model tokens per minute. A limit of None disables that bucket."""
+
+    def __init__(self, requests_per_second: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self._lock = threading.Lock()
+        # [capacity, refill per second, current level]
+        self._requests = [requests_per_second, requests_per_second, requests_per_second] if requests_per_second else None
+        self._tokens = [tokens_per_minute, tokens_per_minute / 60, tokens_per_minute] if tokens_per_minute else None
+        self._last = time.monotonic()
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocks until a request of `tokens` tokens is allowed, returns the time spent waiting."""
+        waited = 0.
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for bucket in filter(None, [self._requests, self._tokens]):
+                    bucket[2] = min(bucket[0], bucket[2] + (now - self._last) * bucket[1])
+                self._last = now
+
+                needs = [(self._requests, 1), (self._tokens, tokens)]
+                needs = [(bucket, min(need, bucket[0])) for bucket, need in needs if bucket is not None]
+                wait = max([(need - bucket[2]) / bucket[1] for bucket, need in needs], default=0.)
+                if wait <= 0:
+                    for bucket, need in needs:
+                        bucket[2] -= need
+                    return waited
+
+            time.sleep(wait)
+            waited += wait
+
+
+class Scheduler:
+    """A fixed pool of worker threads serving per-session request queues round-robin."""
+
+    def __init__(self,
+                 max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                 requests_per_second: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None):
+        """
+        Args:
+            max_concurrency (int): the number of worker threads, i.e. the most requests in flight at once
+            requests_per_second (float, optional): cap on requests started per second
+            tokens_per_minute (float, optional): cap on (estimated) prompt tokens sent per minute
+        """
+        self.max_concurrency = max_concurrency
+        self._limiter = RateLimiter(requests_per_second, tokens_per_minute)
+        self._queues: "OrderedDict[Any, deque]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._local = threading.local()
+        self._shutdown = False
+
+        self.metrics = {"submitted": 0, "completed": 0, "rate_limited_seconds": 0.}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {**self.metrics, "queued": sum(len(q) for q in self._queues.values())}
+
+    @contextmanager
+    def session(self, key: Any):
+        """Attribute requests submitted from this thread to session `key` for fair scheduling."""
+        previous = getattr(self._local, "session", None)
+        self._local.session = key
+        try:
+            yield
+        finally:
+            self._local.session = previous
+
+    def submit(self, fn: Callable, *args, tokens: int = 0) -> Future:
+        future: Future = Future()
+        session = getattr(self._local, "session", None)
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot submit to a scheduler that has been shut down")
+            self._start_workers()
+            # run the request in the submitter's context so context variables (e.g. step deadlines) carry over
+            context = contextvars.copy_context()
+            self._queues.setdefault(session, deque()).append((future, context, fn, args, tokens))
+            self.metrics["submitted"] += 1
+            self._condition.notify()
+
+        return future
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+
+    def _start_workers(self):
+        while len(self._workers) < self.max_concurrency:
+            worker = threading.Thread(target=self._work, daemon=True, name=f"weblm-scheduler-{len(self._workers)}")
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_task(self):
+        while not self._queues and not self._shutdown:
+            self._condition.wait()
+
+        if not self._queues:
+            return None
+
+        # take from the session at the front and send it to the back, so sessions take turns
+        session, queue = next(iter(self._queues.items()))
+        task = queue.popleft()
+        if queue:
+            self._queues.move_to_end(session)
+        else:
+            del self._queues[session]
+
+        return task
+
+    def _work(self):
+        while True:
+            with self._condition:
+                task = self._next_task()
+
+            if task is None:
+                return
+
+            future, context, fn, args, tokens = task
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            waited = self._limiter.acquire(tokens)
+            try:
+                result = context.run(fn, *args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            with self._condition:
+                self.metrics["completed"] += 1
+                self.metrics["rate_limited_seconds"] += waited
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler() -> Scheduler:
+    return _scheduler
+
+
+def configure_scheduler(max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                        requests_per_second: Optional[float] = None,
+                        tokens_per_minute: Optional[float] = None) -> Scheduler:
+    """Replace the process-wide scheduler, e.g. to set rate limits for a deployment."""
+    global _scheduler
+    _scheduler.shutdown()
+    _scheduler = Scheduler(max_concurrency, requests_per_second, tokens_per_minute)
+    return _scheduler
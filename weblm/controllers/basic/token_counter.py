@@ -0,0 +1,164 @@
+"""Token counts of prompts, summed from cached counts of their lines.
+
+Prompts are mostly made of the same pieces (the template, examples, page elements, previous commands) in different
+combinations, so counts are cached per line rather than per prompt. Counting a prompt only calls the tokenizer for
+the lines that haven't been seen before, all of them in a single request, and attributes the resulting tokens back to
+each line. Summing per-line counts can be off by a token where a token would span a line break, which is well within
+the slack the length checks leave. When the token strings don't spell out the text, the exact total of the request is
+shared out between its lines by length instead.
+
+Checks that only need to know whether a prompt is over a limit use `exceeds`, which estimates unseen lines from the
+characters-per-token ratio observed so far and only tokenizes when the estimate is too close to the limit to tell.
+"""
+
+from collections import OrderedDict
+import threading
+from typing import Dict, List
+
+import cohere
+
+from weblm.controllers.basic.retry import call_with_retry
+from weblm.controllers.basic.scheduler import CHARS_PER_TOKEN
+
+# `exceeds` tokenizes when the estimate is within this fraction of the limit
+ESTIMATE_MARGIN = 0.15
+
+
+def split_segments(text: str) -> List[str]:
+    return text.splitlines(keepends=True)
+
+
+class TokenCounter:
+
+    def __init__(self, max_entries: int = 200_000):
+        """
+        Args:
+            max_entries (int): the most line counts to keep, least recently used ones are dropped first
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._chars, self._tokens = 0, 0
+
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "tokenize_calls": 0,
+            "estimates": 0,
+            "truncations": 0,
+            "truncation_tokenize_calls": 0,
+        }
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.metrics, "entries": len(self._counts)}
+
+    @property
+    def chars_per_token(self) -> float:
+        return self._chars / self._tokens if self._tokens else CHARS_PER_TOKEN
+
+    def count(self, co: cohere.Client, text: str) -> int:
+        """The number of tokens in `text`, tokenizing only the lines whose counts aren't cached."""
+        segments = split_segments(text)
+        counts = self._lookup(segments)
+
+        missing = list(OrderedDict.fromkeys(s for s, c in zip(segments, counts) if c is None))
+        if missing:
+            self._learn(co, missing)
+            counts = self._lookup(segments)
+
+        return sum(counts)
+
+    def estimate(self, text: str) -> int:
+        """The number of tokens in `text` from cached counts, estimating unseen lines without the tokenizer."""
+        with self._lock:
+            self.metrics["estimates"] += 1
+            return sum(
+                self._counts[s] if s in self._counts else int(len(s) / self.chars_per_token) + 1
+                for s in split_segments(text))
+
+    def exceeds(self, co: cohere.Client, text: str, limit: int) -> bool:
+        """Whether `text` is longer than `limit` tokens, only tokenizing when an estimate is too close to call."""
+        estimate = self.estimate(text)
+        if estimate < limit * (1 - ESTIMATE_MARGIN):
+            return False
+        elif estimate > limit * (1 + ESTIMATE_MARGIN):
+            return True
+        return self.count(co, text) > limit
+
+    def record_truncation(self, calls: int):
+        """Count a `truncate_left` call that made `calls` tokenize calls."""
+        with self._lock:
+            self.metrics["truncations"] += 1
+            self.metrics["truncation_tokenize_calls"] += calls
+
+    def _lookup(self, segments: List[str]) -> List[int]:
+        counts = []
+        with self._lock:
+            for segment in segments:
+                count = self._counts.get(segment)
+                if count is not None:
+                    self._counts.move_to_end(segment)
+                    self.metrics["hits"] += 1
+                counts.append(count)
+        return counts
+
+    def _learn(self, co: cohere.Client, segments: List[str]):
+        # every segment but the last ends in a line break, so they can be tokenized together and split up again.
+        # The response is lazy, so its token strings are read inside the retried call
+        text = "".join(segments)
+        token_strings = call_with_retry(lambda: co.tokenize(text).token_strings)
+        counts = _attribute(token_strings, segments)
+        if counts is None:
+            # the token strings don't spell out the text (e.g. byte-level tokens on non-ASCII pages). The total is
+            # still exact, share it out between the lines by length rather than tokenizing every line on its own
+            counts = _apportion(len(token_strings), segments)
+        num_calls = 1
+
+        with self._lock:
+            self.metrics["misses"] += len(segments)
+            self.metrics["tokenize_calls"] += num_calls
+            for segment, count in zip(segments, counts):
+                self._counts[segment] = count
+                self._counts.move_to_end(segment)
+                self._chars += len(segment)
+                self._tokens += count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+
+def _attribute(token_strings: List[str], segments: List[str]):
+    """Token counts per segment, each token counted in the segment it ends in. None if the tokens don't match."""
+    if "".join(token_strings) != "".join(segments):
+        return None
+
+    counts = [0] * len(segments)
+    i, end = 0, len(segments[0])
+    position = 0
+    for token in token_strings:
+        position += len(token)
+        while position > end:
+            i += 1
+            end += len(segments[i])
+        counts[i] += 1
+
+    # a segment swallowed by a token that ends in the next one still costs at least a token on its own
+    return [max(1, c) for c in counts]
+
+
+def _apportion(total: int, segments: List[str]) -> List[int]:
+    """Split `total` tokens between segments in proportion to their lengths, keeping the sum exact."""
+    lengths = [len(s) for s in segments]
+    shares = [total * length / max(1, sum(lengths)) for length in lengths]
+    counts = [int(share) for share in shares]
+    # hand the tokens lost to rounding down to the segments with the largest remainders
+    for i in sorted(range(len(segments)), key=lambda i: counts[i] - shares[i])[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+_counter = TokenCounter()
+
+
+def get_token_counter() -> TokenCounter:
+    return _counter
@@ -1,20 +1,31 @@
 """Misc. utility functions"""
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from concurrent.futures import Future
 from enum import Enum
-import itertools
-import json
-import math
 import random
-from typing import Any, Dict, List, Tuple
+from string import Formatter
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import cohere
 import numpy as np
 
+from weblm.controllers.basic.retry import call_with_retry
+from weblm.example_store import get_example_store
+from weblm.controllers.basic.scheduler import estimate_tokens, get_scheduler
+from weblm.controllers.basic.token_counter import get_token_counter
+
 MAX_SEQ_LEN = 2000
 MAX_NUM_ELEMENTS = 30
 TYPEABLE = ["input", "select"]
 CLICKABLE = ["link", "button"]
 MODEL = "xlarge"
+# how `choose` scores options when only their ranking matters (prioritization and element selection), see `choose`.
+# "suffix" only scores the tokens of each option itself, it hasn't been evaluated against "full" yet
+RANK_SCORING = "full"
+# with suffix scoring, `choose_element` drops the options of a group that its best option beats by this summed
+# log-likelihood
+PRUNE_MARGIN = 2.
 
 prompt_template = """Given:
     (1) an objective that you are trying to achieve
@@ -72,13 +83,45 @@ class DialogueState(Enum):
 
 
 def truncate_left(tokenize, prompt, *rest_of_prompt, limit=2048):
-    i = 0
-    chop_size = 5
-    print(f"WARNING: truncating sequence of length {len(tokenize(prompt + ''.join(rest_of_prompt)))} to length {limit}")
-    while len(tokenize(prompt + "".join(rest_of_prompt))) > limit:
-        prompt = prompt[i * chop_size:]
-        i += 1
-    return prompt
+    """Cut the start of `prompt` so that it and `rest_of_prompt` fit in `limit` tokens.
+
+    The prompt is tokenized once and cut at the token boundary that leaves `limit` tokens. If the token strings don't
+    spell out the prompt, or the cut prompt still doesn't fit, the cut is binary searched instead, with a tokenize call
+    per step. The number of calls made is added to the token counter's stats.
+    """
+    rest = "".join(rest_of_prompt)
+    tokenized = tokenize(prompt + rest)
+    calls = 1
+    length = len(tokenized)
+    if length <= limit:
+        return prompt
+
+    tokens = getattr(tokenized, "token_strings", None)
+    cut = None
+    if tokens is not None and "".join(tokens) == prompt + rest:
+        cut = sum(len(t) for t in tokens[:length - limit])
+        if cut > len(prompt):
+            cut = len(prompt)
+        else:
+            calls += 1
+            if len(tokenize(prompt[cut:] + rest)) > limit:
+                cut = None
+
+    if cut is None:
+        # smallest cut that fits, the token count only shrinks as more is cut
+        lo, hi = 0, len(prompt)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            calls += 1
+            if len(tokenize(prompt[mid:] + rest)) > limit:
+                lo = mid + 1
+            else:
+                hi = mid
+        cut = lo
+
+    print(f"WARNING: truncated sequence of length {length} to length {limit} with {calls} tokenize calls")
+    get_token_counter().record_truncation(calls)
+    return prompt[cut:]
 
 
 def split_list_by_separators(l: List[Any], separator_sequences: List[List[Any]]) -> List[List[Any]]:
@@ -115,8 +158,8 @@ def split_list_by_separators(l: List[Any], separator_sequences: List[List[Any]])
 
 
 def search(co: cohere.Client, query: str, items: List[str], topk: int) -> List[str]:
-    embedded_items = np.array(co.embed(texts=items, truncate="RIGHT").embeddings)
-    embedded_query = np.array(co.embed(texts=[query], truncate="RIGHT").embeddings[0])
+    embeds = get_example_store().embed(co, [query] + items)
+    embedded_query, embedded_items = embeds[0], embeds[1:]
     scores = np.einsum("i,ji->j", embedded_query,
                        embedded_items) / (np.linalg.norm(embedded_query) * np.linalg.norm(embedded_items, axis=1))
     ind = np.argsort(scores)[-topk:]
@@ -141,6 +184,13 @@ def construct_prompt(state: str, examples: List[str]) -> str:
     return prompt.replace("$state", state)
 
 
+def _score(co: cohere.Client, prompt: str, return_likelihoods: str) -> float:
+    if get_token_counter().exceeds(co, prompt, 2048):
+        prompt = truncate_left(co.tokenize, prompt)
+    return co.generate(prompt=prompt, max_tokens=0, model=MODEL,
+                       return_likelihoods=return_likelihoods).generations[0].likelihood
+
+
 def _fn(x):
     if len(x) == 3:
         option, prompt, co = x
@@ -148,86 +198,145 @@ def _fn(x):
     elif len(x) == 4:
         option, prompt, co, return_likelihoods = x
 
-    while True:
-        try:
-            if len(co.tokenize(prompt)) > 2048:
-                prompt = truncate_left(co.tokenize, prompt)
-            return (co.generate(prompt=prompt, max_tokens=0, model=MODEL,
-                                return_likelihoods=return_likelihoods).generations[0].likelihood, option)
-        except cohere.error.CohereError as e:
-            print(f"Cohere fucked up: {e}")
-            continue
-        except ConnectionError as e:
-            print(f"Connection error: {e}")
-            continue
+    return call_with_retry(_score, co, prompt, return_likelihoods), option
+
+
+def _score_suffix(co: cohere.Client, prompt: str, num_option_tokens: int) -> float:
+    if get_token_counter().exceeds(co, prompt, 2048):
+        prompt = truncate_left(co.tokenize, prompt)
+
+    token_likelihoods = co.generate(prompt=prompt, max_tokens=0, model=MODEL,
+                                    return_likelihoods="ALL").generations[0].token_likelihoods
+    return float(sum(t.likelihood for t in token_likelihoods[-num_option_tokens:]))
+
+
+def _fn_suffix(option: Dict[str, str], co: cohere.Client, prompt: str, num_option_tokens: int):
+    return call_with_retry(_score_suffix, co, prompt, num_option_tokens), option
+
+
+def _last_field(template: str) -> str:
+    """The name of the field `template` ends with."""
+    *_, (_, field, _, _) = Formatter().parse(template)
+    if field is None:
+        raise ValueError("suffix scoring needs a template that ends with the option's field")
+    return field
 
 
 def choose(co: cohere.Client,
            template: str,
            options: List[Dict[str, str]],
            return_likelihoods: str = "ALL",
-           topk: int = 1) -> List[Tuple[int, Dict[str, str]]]:
+           topk: int = 1,
+           scoring: str = "full") -> List[Tuple[int, Dict[str, str]]]:
     """Choose the most likely continuation of `prompt` from a set of `options`.
 
     Args:
         template (str): a string template with keys that match the dictionaries in `options`
         options (List[Dict[str, str]]): the options to be chosen from
+        scoring (str): "full" scores each option by the likelihood the model reports for its whole prompt. "suffix"
+            scores each option by the summed log-likelihood of only its own tokens, which the template has to end
+            with.
 
     Returns:
         str: the most likely option from `options`
     """
-    num_options = len(options)
-    with ThreadPoolExecutor(num_options) as pp:
-        _lh = pp.map(
-            _fn,
-            zip(options, [template.format(**option) for option in options], [co] * num_options,
-                [return_likelihoods] * num_options))
+    _lh = [future.result() for future in _submit_options(co, template, options, return_likelihoods, scoring)]
     return sorted(_lh, key=lambda x: x[0], reverse=True)[:topk]
 
 
+def _submit_options(co: cohere.Client, template: str, options: List[Dict[str, str]], return_likelihoods: str,
+                    scoring: str) -> List[Future]:
+    """Submit the scoring of every option to the scheduler, see `choose`. Each future resolves to (score, option)."""
+    scheduler = get_scheduler()
+    prompts = [template.format(**option) for option in options]
+
+    if scoring == "suffix":
+        field = _last_field(template)
+        return [
+            scheduler.submit(_fn_suffix,
+                             option,
+                             co,
+                             prompt,
+                             max(1, get_token_counter().count(co, str(option[field]))),
+                             tokens=estimate_tokens(prompt)) for option, prompt in zip(options, prompts)
+        ]
+
+    return [
+        scheduler.submit(_fn, (option, prompt, co, return_likelihoods), tokens=estimate_tokens(prompt))
+        for option, prompt in zip(options, prompts)
+    ]
+
+
 def choose_element(co: cohere.Client,
                    template: str,
                    options: List[Dict[str, str]],
                    group_size: int = 10,
-                   topk: int = 1) -> List[Dict[str, str]]:
+                   topk: int = 1,
+                   scoring: str = "full",
+                   prune_margin: Optional[float] = PRUNE_MARGIN,
+                   stats: Dict[str, int] = None) -> List[Dict[str, str]]:
     """A hacky way of choosing the most likely option, while staying within sequence length constraints
 
         Algo:
         1. chunk `options` into groups of `group_size`
         2. within each group perform a self.choose to get the topk elements (we'll have num_groups*topk elements after this)
-        3. flatten and repeat recursively until the number of options is down to topk
+        3. flatten and repeat until the number of options is down to topk
+
+        All groups of a round are submitted to the scheduler before any of them is waited on, so a round costs one
+        network wait rather than one per group. Scores are only compared within the prompt they were computed in: with
+        suffix scoring, the options of a group that its best option beats by `prune_margin` are not carried into the
+        next round, so later rounds score fewer options.
 
         Args:
             template (str): the prompt template with f-string style template tags 
             options (List[Dict[str, str]]): a list of dictionaries containing key-value replacements of the template tags
             group_size (int, optional): The size of each group of options to select from. Defaults to 10.
             topk (int, optional): The topk most likely options to return. Defaults to 1.
+            scoring (str, optional): How `choose` scores the options. Defaults to "full".
+            prune_margin (float, optional): Summed log-likelihood margin within a group beyond which its weaker options
+                are dropped, None to always carry the topk of every group. Only used with suffix scoring.
+            stats (Dict[str, int], optional): counters to record "element_selections", "element_selection_rounds",
+                "element_selection_calls" (requests submitted) and "element_selection_pruned" in
 
         Returns:
             List[Dict[str, str]]: The `topk` most likely elements in `options` according to the model
         """
-    num_options = len(options)
-    num_groups = int(math.ceil(num_options / group_size))
-
-    if num_options == 0:
+    if len(options) == 0:
         raise Exception()
 
-    choices = []
-    for i in range(num_groups):
-        group = options[i * group_size:(i + 1) * group_size]
-        template_tmp = template.replace("elements", "\n".join(item["elements"] for item in group))
-        options_tmp = [{"id": item["id"]} for item in group]
+    stats = stats if stats is not None else defaultdict(int)
+    stats["element_selections"] += 1
 
-        choice = [x[1] for x in choose(co, template_tmp, options_tmp, topk=topk)]
-        chosen_elements = []
-        for x in choice:
-            chosen_elements.append(list(filter(lambda y: y["id"] == x["id"], group))[0])
-        choices.extend(chosen_elements)
-
-    if len(choices) <= topk:
-        return choices
-    else:
-        return choose_element(co, template, choices, group_size, topk)
+    while True:
+        rounds = []
+        for i in range(0, len(options), group_size):
+            group = options[i:i + group_size]
+            template_tmp = template.replace("elements", "\n".join(item["elements"] for item in group))
+            options_tmp = [{"id": item["id"]} for item in group]
+            futures = _submit_options(co, template_tmp, options_tmp, "ALL", scoring)
+            rounds.append((group, futures))
+            stats["element_selection_calls"] += len(futures)
+        stats["element_selection_rounds"] += 1
+
+        prune = scoring == "suffix" and prune_margin is not None and len(rounds) > 1
+        choices = []
+        num_pruned = 0
+        for group, futures in rounds:
+            choice = sorted((future.result() for future in futures), key=lambda x: x[0], reverse=True)[:topk]
+            if prune:
+                kept = [(score, x) for score, x in choice if choice[0][0] - score < prune_margin]
+                num_pruned += len(choice) - len(kept)
+                choice = kept
+            for _, x in choice:
+                choices.append(list(filter(lambda y: y["id"] == x["id"], group))[0])
+        stats["element_selection_pruned"] += num_pruned
+
+        # options from different groups were never scored against each other, only return them unranked like before
+        # if the margin didn't decide which of them to keep
+        if len(choices) <= topk and (len(rounds) == 1 or num_pruned == 0):
+            return choices
+
+        options = choices
 
 
 def shorten_prompt(co: cohere.Client,
@@ -241,20 +350,11 @@ def shorten_prompt(co: cohere.Client,
     state = construct_state(objective, url, elements, previous_commands)
     prompt = construct_prompt(state, examples)
 
-    tokenized_prompt = co.tokenize(prompt + "".join(rest_of_prompt))
-    tokens = tokenized_prompt.token_strings
-
-    split_tokens = split_list_by_separators(
-        tokens, [['EX', 'AMP', 'LE'], ["Example", ":", "\n"], ["Example"], ["Present", " state", ":", "\n"]])
-    example_tokens = split_tokens[1:-1]
-    length_of_examples = list(map(len, example_tokens))
-    state_tokens = split_tokens[-1]
-    state_tokens = list(
-        itertools.chain.from_iterable(
-            split_list_by_separators(state_tokens, [['----', '----', '----', '----', '--', '\n']])[1:-1]))
-    state_tokens = split_list_by_separators(state_tokens, [["\n"]])
-    length_of_elements = list(map(len, state_tokens))
-    length_of_prompt = len(tokenized_prompt)
+    # counting the whole prompt caches the count of every line in it, so the examples and elements are then free
+    counter = get_token_counter()
+    length_of_prompt = counter.count(co, prompt + "".join(rest_of_prompt))
+    length_of_examples = [counter.count(co, example + "\n\n") for example in examples]
+    length_of_elements = [counter.count(co, element + "\n") for element in elements]
 
     def _fn(i, j):
         state = construct_state(objective, url, elements[:len(elements) - i], previous_commands)
@@ -273,7 +373,7 @@ def shorten_prompt(co: cohere.Client,
     print(f"num examples: {len(examples) - j}")
 
     state, prompt = _fn(i, j)
-    if len(co.tokenize(prompt + "".join(rest_of_prompt))) <= target:
+    if counter.count(co, prompt + "".join(rest_of_prompt)) <= target:
         return state, prompt
 
     MIN_ELEMENTS = 7
@@ -286,54 +386,93 @@ def shorten_prompt(co: cohere.Client,
     state, prompt = _fn(i, j)
 
     # last resort, start cutting off the bigging of the prompt
-    if len(co.tokenize(prompt + "".join(rest_of_prompt))) > target:
+    if counter.count(co, prompt + "".join(rest_of_prompt)) > target:
         prompt = truncate_left(co.tokenize, prompt, *rest_of_prompt, limit=target)
 
     return state, prompt
 
 
-def gather_examples(co: cohere.Client, state: str, topk: int = 5, max_elements: int = 10) -> List[str]:
-    """Simple semantic search over a file of past interactions to find the most similar ones."""
-    with open("examples.json", "r") as fd:
-        history = json.load(fd)
+class ExampleCache:
+    """Memoizes `gather_examples` so the stages of a step that look up examples for the same state share one lookup.
 
-    if len(history) == 0:
-        return []
+    Speculative branches use it from their own threads. A lookup holds the lock while it runs, so a branch asking for
+    a state that another one is already looking up waits for that lookup instead of repeating it.
+    """
+
+    def __init__(self, stats: Dict[str, int] = None):
+        """
+        Args:
+            stats (Dict[str, int], optional): counters to record "examples_hits" and "examples_misses" in
+        """
+        self.stats = stats if stats is not None else defaultdict(int)
+        self._examples: Dict[Tuple[str, int, int], List[str]] = {}
+        self._lock = threading.Lock()
+
+    def gather_examples(self, co: cohere.Client, state: str, topk: int = 5, max_elements: int = 10) -> List[str]:
+        key = (state, topk, max_elements)
+        with self._lock:
+            if key in self._examples:
+                self.stats["examples_hits"] += 1
+            else:
+                self.stats["examples_misses"] += 1
+                self._examples[key] = gather_examples(co, state, topk, max_elements)
 
-    embeds = [h["embedding"] for h in history]
-    examples = [h["example"] for h in history]
-    embeds = np.array(embeds)
-    embedded_state = np.array(co.embed(texts=[state], truncate="RIGHT").embeddings[0])
-    scores = np.einsum("i,ji->j", embedded_state,
-                       embeds) / (np.linalg.norm(embedded_state) * np.linalg.norm(embeds, axis=1))
-    ind = np.argsort(scores)[::-1]
+            return self._examples[key]
 
-    states = []
-    for i in ind:
-        if len(states) == topk:
-            break
 
-        h = history[int(i)]
-        if all(x in h for x in ["objective", "url", "elements", "previous_commands", "command"]):
-            elements = list(filter(lambda x: x[:4] != "text", h["elements"]))
+def command_element(record: Dict[str, Any]) -> Optional[str]:
+    """The page element a saved example's command acts on, None if it can't be told apart from the others."""
+    elements = [x for x in record["elements"] if x[:4] != "text"]
+    target = " ".join(record["command"].split()[1:3])
+    matches = [x for x in elements if target in x]
+    return matches[0] if len(matches) == 1 else None
+
 
-            command_element = " ".join(h["command"].split()[1:3])
-            command_element = list(filter(lambda x: command_element in x, elements))
-            assert len(command_element) == 1, f"length is {len(command_element)}"
-            command_element = command_element[0]
+def is_example_record(record: Dict[str, Any]) -> bool:
+    return (all(x in record for x in ["objective", "url", "elements", "previous_commands", "command"]) and
+            command_element(record) is not None)
 
-            if not command_element in elements[:max_elements]:
-                rand_idx = random.randint(0, max_elements - 1)
-                elements = elements[:rand_idx] + [command_element] + elements[rand_idx:]
 
-            elements = elements[:max_elements]
+def is_prioritisation_record(record: Dict[str, Any]) -> bool:
+    return all(x in record for x in ["objective", "command", "url", "elements"]) and command_element(record) is not None
 
-            state = construct_state(objective=h["objective"],
-                                    url=h["url"],
-                                    page_elements=elements,
-                                    previous_commands=h["previous_commands"])
-            state += f"\nNext Command: {h['command']}"
 
-            states.append(state)
+def retrieve_examples(co: cohere.Client, state: str, topk: int,
+                      where: Callable[[Dict[str, Any]], bool]) -> List[Dict[str, Any]]:
+    """The `topk` stored records most similar to `state` that `where` accepts, most similar first.
+
+    Records `where` rejects are masked out before scoring, so exactly `topk` records come back whenever there are
+    that many valid ones.
+    """
+    store = get_example_store()
+    if len(store) == 0:
+        return []
+
+    _, records = store.nearest(store.embed(co, [state])[0], topk, where=where)
+    return records
+
+
+def include_command_element(record: Dict[str, Any], num_elements: int) -> List[str]:
+    """The first `num_elements` non-text elements of a record, making sure the one its command acts on is included."""
+    elements = [x for x in record["elements"] if x[:4] != "text"]
+    element = command_element(record)
+    if not element in elements[:num_elements]:
+        rand_idx = random.randint(0, num_elements - 1)
+        elements = elements[:rand_idx] + [element] + elements[rand_idx:]
+
+    return elements[:num_elements]
+
+
+def gather_examples(co: cohere.Client, state: str, topk: int = 5, max_elements: int = 10) -> List[str]:
+    """Simple semantic search over the store of past interactions to find the most similar ones."""
+    states = []
+    for h in retrieve_examples(co, state, topk, where=is_example_record):
+        state = construct_state(objective=h["objective"],
+                                url=h["url"],
+                                page_elements=include_command_element(h, max_elements),
+                                previous_commands=h["previous_commands"])
+        state += f"\nNext Command: {h['command']}"
+
+        states.append(state)
 
     return states
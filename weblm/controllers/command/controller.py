@@ -1,11 +1,11 @@
 import csv
-import json
 import os
 import re
 from collections import defaultdict
-from typing import DefaultDict, Dict, List, Tuple, Union
+from typing import Any, DefaultDict, Dict, List, Tuple, Union
 
 import cohere
+from weblm.example_store import get_example_store
 from weblm.utils import Command, Prompt, HELP_MSG
 
 
@@ -48,41 +48,38 @@ class Controller:
         self._error = None
 
     def success(self):
-        for url, elements, command, previous_commands in self.moments:
-            self._save_example(objective=self.objective,
-                               url=url,
-                               elements=elements,
-                               command=command,
-                               previous_commands=previous_commands)
+        self._save_examples([
+            self._example_record(self.objective, url, elements, command, previous_commands)
+            for url, elements, command, previous_commands in self.moments
+        ])
 
     def _save_example(self, objective: str, url: str, elements: List[str], command: str, previous_commands: List[str]):
+        self._save_examples([self._example_record(objective, url, elements, command, previous_commands)])
+
+    def _example_record(self, objective: str, url: str, elements: List[str], command: str,
+                        previous_commands: List[str]) -> Dict[str, Any]:
         state = construct_state(objective, url, elements[:MAX_NUM_ELEMENTS], previous_commands)
         example = ("Example:\n"
                    f"{state}\n"
                    f"Next Command: {command}\n"
                    "----")
-        print(f"Example being saved:\n{example}")
-        with open("examples.json", "r") as fd:
-            history = json.load(fd)
-            examples = [h["example"] for h in history]
-
-        if example in examples:
-            print("example already exists")
-            return
-
-        history.append({
+        return {
             "example": example,
-            "embedding": self.co.embed(texts=[example]).embeddings[0],
             "url": url,
             "elements": elements,
             "command": command,
             "previous_commands": previous_commands,
             "objective": objective,
-        })
+        }
+
+    def _save_examples(self, records: List[Dict[str, Any]]):
+        """Embed the new examples in batched requests and append them to the store in one write."""
+        for record in records:
+            print(f"Example being saved:\n{record['example']}")
 
-        with open("examples_tmp.json", "w") as fd:
-            json.dump(history, fd)
-        os.replace("examples_tmp.json", "examples.json")
+        added = get_example_store().ingest(self.co, records)
+        if added < len(records):
+            print(f"{len(records) - added} examples already exist")
 
     def _construct_responses(self):
         keys_to_save = ["y", "n", "s", "command", "success", "cancel"]
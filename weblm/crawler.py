@@ -5,7 +5,10 @@ import time
 from os.path import exists
 from sys import platform
 
+import numpy as np
 from playwright.async_api import async_playwright
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from playwright.sync_api import sync_playwright
 
 black_listed_elements = set([
@@ -25,6 +28,50 @@ black_listed_elements = set([
 
 URL_PATTERN = r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*)"
 WINDOW_SIZE = {"width": 1280, "height": 1080}
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"
+
+# how to decide that a page is ready to be crawled after a command:
+#   sleep: wait for the full settle timeout
+#   load / networkidle: wait for the corresponding playwright load state
+#   dom: wait for DOMContentLoaded and then until the DOM has been quiet for DOM_QUIET_MS
+SETTLE_STRATEGIES = ["sleep", "load", "networkidle", "dom"]
+DOM_QUIET_MS = 500
+# messages of the errors a settle wait gets when the page navigates under it, any other error (e.g. a closed page) is
+# raised rather than retried
+NAVIGATION_ERRORS = ["execution context was destroyed", "navigat", "frame was detached"]
+
+# resolves once no mutations have been observed for `quietMs`, or after `timeoutMs`
+WAIT_FOR_DOM_QUIET_JS = """
+([quietMs, timeoutMs]) => new Promise((resolve) => {
+    let timer = null;
+    const finish = () => {
+        observer.disconnect();
+        clearTimeout(timer);
+        clearTimeout(deadline);
+        resolve();
+    };
+    const observer = new MutationObserver(() => {
+        clearTimeout(timer);
+        timer = setTimeout(finish, quietMs);
+    });
+    observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    timer = setTimeout(finish, quietMs);
+    const deadline = setTimeout(finish, timeoutMs);
+})
+"""
+
+SNAPSHOT_PARAMS = {"computedStyles": ["display"], "includeDOMRects": True, "includePaintOrder": True}
+
+# everything `Crawler._crawl` needs to know about the window, in a single round-trip
+VIEWPORT_METRICS_JS = """
+() => ({
+    devicePixelRatio: window.devicePixelRatio,
+    pageXOffset: window.pageXOffset,
+    pageYOffset: window.pageYOffset,
+    screenWidth: window.screen.width,
+    screenHeight: window.screen.height,
+})
+"""
 
 
 def replace_special_fields(cmd):
@@ -38,14 +85,65 @@ def replace_special_fields(cmd):
     return cmd
 
 
+def _is_navigation_error(error):
+    message = str(error).lower()
+    return any(e in message for e in NAVIGATION_ERRORS)
+
+
+async def _timed(awaitable, timings, phase):
+    phase_start = time.time()
+    result = await awaitable
+    timings[phase] = time.time() - phase_start
+    return result
+
+
+def _filter_layout(strings, bounds, styles, device_pixel_ratio, win_left_bound, win_upper_bound, win_right_bound,
+                   win_lower_bound):
+    """Compute per layout node visibility, scaled bounds and centers in one pass over the snapshot's layout arrays.
+
+    Returns plain python lists (indexed by layout index) so the node walk in `Crawler._crawl` doesn't pay for numpy
+    scalar access.
+    """
+    scaled_bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4) / device_pixel_ratio
+    x, y, width, height = scaled_bounds.T
+
+    none_ids = [i for i, s in enumerate(strings) if s == "none"]
+    try:
+        display_none = np.isin(np.asarray(styles, dtype=np.int64), none_ids).reshape(len(styles), -1).any(axis=1)
+    except ValueError:  # ragged styles, not expected when only `display` is captured
+        none_ids = set(none_ids)
+        display_none = np.fromiter((any(s in none_ids for s in style) for style in styles), dtype=bool, count=len(styles))
+
+    partially_is_in_viewport = ((x < win_right_bound) & (x + width >= win_left_bound) & (y < win_lower_bound) &
+                                (y + height >= win_upper_bound))
+
+    keep = partially_is_in_viewport & ~display_none
+    centers_x = (x + (width / 2)).astype(np.int64)
+    centers_y = (y + (height / 2)).astype(np.int64)
+
+    return keep.tolist(), scaled_bounds.tolist(), centers_x.tolist(), centers_y.tolist()
+
+
 class Crawler:
 
-    def __init__(self):
+    def __init__(self,
+                 vectorized: bool = True,
+                 settle: str = "dom",
+                 settle_timeout: float = 10.):
+        """
+        Args:
+            vectorized (bool): filter the snapshot's layout arrays with numpy instead of node by node in python
+            settle (str): how to wait for the page after navigating or running a command, one of SETTLE_STRATEGIES
+            settle_timeout (float): the longest to wait for the page to settle, in seconds
+        """
+        assert settle in SETTLE_STRATEGIES, f"unknown settle strategy {settle}"
+        self.vectorized = vectorized
+        self.settle_strategy = settle
+        self.settle_timeout = settle_timeout
+        self.last_crawl_timings = {}
+        self.last_settle_time = None
         self.browser = sync_playwright().start().chromium.launch(headless=False,)
-        self.context = self.browser.new_context(
-            user_agent=
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"
-        )
+        self.context = self.browser.new_context(user_agent=USER_AGENT)
 
         self.page = self.context.new_page()
         self.page.set_viewport_size(WINDOW_SIZE)
@@ -53,6 +151,9 @@ class Crawler:
     def go_to_page(self, url):
         self.page.goto(url=url if "://" in url else "http://" + url)
         self.client = self.page.context.new_cdp_session(self.page)
+        self._reset_page_state()
+
+    def _reset_page_state(self):
         self.page_element_buffer = {}
 
     def scroll(self, direction):
@@ -102,31 +203,71 @@ class Crawler:
     def enter(self):
         self.page.keyboard.press("Enter")
 
+    def settle(self):
+        """Wait for the page to settle according to `self.settle_strategy`, returns how long it waited."""
+        start = time.time()
+        deadline = start + self.settle_timeout
+
+        if self.settle_strategy == "sleep":
+            time.sleep(self.settle_timeout)
+
+        while self.settle_strategy != "sleep" and time.time() < deadline:
+            timeout_ms = (deadline - time.time()) * 1000
+            try:
+                if self.settle_strategy == "dom":
+                    self.page.wait_for_load_state("domcontentloaded", timeout=timeout_ms)
+                    self.page.evaluate(WAIT_FOR_DOM_QUIET_JS, [DOM_QUIET_MS, timeout_ms])
+                else:
+                    self.page.wait_for_load_state(self.settle_strategy, timeout=timeout_ms)
+                break
+            except PlaywrightTimeoutError:
+                print("Page did not settle before the timeout")
+                break
+            except PlaywrightError as e:
+                if not _is_navigation_error(e):
+                    raise
+                # the page navigated while we were waiting, wait on the new document instead
+                continue
+
+        return self._report_settle(start)
+
+    def _report_settle(self, start):
+        self.last_settle_time = time.time() - start
+        print("Settle time: {:0.2f} seconds".format(self.last_settle_time))
+        return self.last_settle_time
+
     def crawl(self):
         start = time.time()
 
         page = self.page
-        tree = self.client.send(
-            "DOMSnapshot.captureSnapshot",
-            {
-                "computedStyles": ["display"],
-                "includeDOMRects": True,
-                "includePaintOrder": True
-            },
-        )
-        device_pixel_ratio = page.evaluate("window.devicePixelRatio")
-        win_scroll_x = page.evaluate("window.scrollX")
-        win_scroll_y = page.evaluate("window.scrollY")
-        win_upper_bound = page.evaluate("window.pageYOffset")
-        win_left_bound = page.evaluate("window.pageXOffset")
-        win_width = page.evaluate("window.screen.width")
-        win_height = page.evaluate("window.screen.height")
-        elements_of_interest = self._crawl(tree, win_upper_bound, win_width, win_left_bound, win_height,
-                                           device_pixel_ratio)
-
-        print("Parsing time: {:0.2f} seconds".format(time.time() - start))
+        timings = {}
+        phase_start = time.time()
+        tree = self.client.send("DOMSnapshot.captureSnapshot", SNAPSHOT_PARAMS)
+        timings["snapshot"] = time.time() - phase_start
+
+        phase_start = time.time()
+        metrics = page.evaluate(VIEWPORT_METRICS_JS)
+        timings["metrics"] = time.time() - phase_start
+
+        elements_of_interest = self._parse(tree, metrics, timings)
+
+        self._report_timings(start, timings)
+        return elements_of_interest
+
+    def _parse(self, tree, metrics, timings):
+        phase_start = time.time()
+        elements_of_interest = self._crawl(tree, metrics["pageYOffset"], metrics["screenWidth"], metrics["pageXOffset"],
+                                           metrics["screenHeight"], metrics["devicePixelRatio"])
+        timings["parse"] = time.time() - phase_start
+
         return elements_of_interest
 
+    def _report_timings(self, start, timings):
+        timings["total"] = time.time() - start
+        self.last_crawl_timings = timings
+        print("Parsing time: {:0.2f} seconds".format(timings["total"]) + " (" +
+              ", ".join("{}: {:0.2f}s".format(phase, t) for phase, t in timings.items() if phase != "total") + ")")
+
     def _crawl(self, tree, win_upper_bound, win_width, win_left_bound, win_height, device_pixel_ratio):
         page_element_buffer = self.page_element_buffer
 
@@ -176,6 +317,12 @@ class Crawler:
         bounds = layout["bounds"]
         styles = layout["styles"]
 
+        if self.vectorized:
+            keep_layout, scaled_bounds, centers_x, centers_y = _filter_layout(strings, bounds, styles,
+                                                                              device_pixel_ratio, win_left_bound,
+                                                                              win_upper_bound, win_right_bound,
+                                                                              win_lower_bound)
+
         cursor = 0
         html_elements_text = []
 
@@ -210,20 +357,32 @@ class Crawler:
 
             return values
 
-        def add_to_hash_tree(hash_tree, tag, node_id, node_name, parent_id):
-            parent_id_str = str(parent_id)
-            if not parent_id_str in hash_tree:
-                parent_name = strings[node_names[parent_id]].lower()
-                grand_parent_id = parent[parent_id]
+        # lookup tables built once per snapshot so the walk below stays linear in the number of nodes
+        layout_index_of = {}
+        for layout_index, node_index in enumerate(layout_node_index):
+            layout_index_of.setdefault(node_index, layout_index)
 
-                add_to_hash_tree(hash_tree, tag, parent_id, parent_name, grand_parent_id)
+        input_value_of = {}
+        for value_index, node_index in enumerate(input_value_index):
+            input_value_of.setdefault(node_index, input_value_values[value_index])
 
-            is_parent_desc_anchor, anchor_id = hash_tree[parent_id_str]
+        node_roles = [find_attributes(node_attributes, ["role"]).get("role") for node_attributes in attributes]
 
-            element_attributes = find_attributes(attributes[node_id], ["role"])
+        def add_to_hash_tree(hash_tree, tag, node_id, node_name, parent_id):
+            if parent_id < 0:
+                parent_value = (False, None)
+            else:
+                parent_value = hash_tree[parent_id]
+                if parent_value is None:
+                    parent_name = strings[node_names[parent_id]].lower()
+                    grand_parent_id = parent[parent_id]
+
+                    parent_value = add_to_hash_tree(hash_tree, tag, parent_id, parent_name, grand_parent_id)
+
+            is_parent_desc_anchor, anchor_id = parent_value
 
             # even if the anchor is nested in another anchor, we set the "root" for all descendants to be ::Self
-            if node_name in tag or element_attributes.get("role") in tag:
+            if node_name in tag or node_roles[node_id] in tag:
                 value = (True, node_id)
             elif (is_parent_desc_anchor):  # reuse the parent's anchor_id (which could be much higher in the tree)
                 value = (True, anchor_id)
@@ -233,13 +392,14 @@ class Crawler:
                     None,
                 )  # not a descendant of an anchor, most likely it will become text, an interactive element or discarded
 
-            hash_tree[str(node_id)] = value
+            hash_tree[node_id] = value
 
             return value
 
-        anchor_ancestry = {"-1": (False, None)}
-        button_ancestry = {"-1": (False, None)}
-        select_ancestry = {"-1": (False, None)}
+        # indexed by node index, None until the node has been visited
+        anchor_ancestry = [None] * len(node_names)
+        button_ancestry = [None] * len(node_names)
+        select_ancestry = [None] * len(node_names)
 
         for index, node_name_index in enumerate(node_names):
             node_parent = parent[index]
@@ -253,35 +413,45 @@ class Crawler:
             is_ancestor_of_select, select_id = add_to_hash_tree(select_ancestry, ["select"], index, node_name,
                                                                 node_parent)
 
-            try:
-                cursor = layout_node_index.index(select_id) if is_ancestor_of_select else layout_node_index.index(index)
-            except:
+            cursor = layout_index_of.get(select_id if is_ancestor_of_select else index)
+            if cursor is None:
                 continue
 
             if node_name in black_listed_elements:
                 continue
 
-            style = map(lambda x: strings[x], styles[cursor])
-            if "none" in style:
-                continue
+            if self.vectorized:
+                if not keep_layout[cursor]:
+                    continue
+
+                [x, y, width, height] = scaled_bounds[cursor]
+                center_x = centers_x[cursor]
+                center_y = centers_y[cursor]
+            else:
+                style = map(lambda x: strings[x], styles[cursor])
+                if "none" in style:
+                    continue
 
-            [x, y, width, height] = bounds[cursor]
-            x /= device_pixel_ratio
-            y /= device_pixel_ratio
-            width /= device_pixel_ratio
-            height /= device_pixel_ratio
+                [x, y, width, height] = bounds[cursor]
+                x /= device_pixel_ratio
+                y /= device_pixel_ratio
+                width /= device_pixel_ratio
+                height /= device_pixel_ratio
 
-            elem_left_bound = x
-            elem_top_bound = y
-            elem_right_bound = x + width
-            elem_lower_bound = y + height
+                elem_left_bound = x
+                elem_top_bound = y
+                elem_right_bound = x + width
+                elem_lower_bound = y + height
 
-            # comment this bit out to process the whole thing
-            partially_is_in_viewport = (elem_left_bound < win_right_bound and elem_right_bound >= win_left_bound and
-                                        elem_top_bound < win_lower_bound and elem_lower_bound >= win_upper_bound)
+                # comment this bit out to process the whole thing
+                partially_is_in_viewport = (elem_left_bound < win_right_bound and elem_right_bound >= win_left_bound and
+                                            elem_top_bound < win_lower_bound and elem_lower_bound >= win_upper_bound)
 
-            if not partially_is_in_viewport:
-                continue
+                if not partially_is_in_viewport:
+                    continue
+
+                center_x = int(x + (width / 2))
+                center_y = int(y + (height / 2))
 
             meta_data = []
 
@@ -295,12 +465,12 @@ class Crawler:
             ancestor_node_key = None
             if ancestor_exception:
                 if is_ancestor_of_anchor:
-                    ancestor_node_key = str(anchor_id)
+                    ancestor_node_key = anchor_id
                 elif is_ancestor_of_button:
-                    ancestor_node_key = str(button_id)
+                    ancestor_node_key = button_id
                 elif is_ancestor_of_select:
-                    ancestor_node_key = str(select_id)
-            ancestor_node = (None if not ancestor_exception else child_nodes.setdefault(str(ancestor_node_key), []))
+                    ancestor_node_key = select_id
+            ancestor_node = (None if not ancestor_exception else child_nodes.setdefault(ancestor_node_key, []))
 
             if node_name == "#text" and ancestor_exception:
                 text = strings[node_value[index]]
@@ -329,10 +499,9 @@ class Crawler:
                 element_node_value = strings[node_value[index]]
                 if element_node_value == "|":  #commonly used as a seperator, does not add much context - lets save ourselves some token space
                     continue
-            elif (node_name == "input" and index in input_value_index and element_node_value is None):
-                node_input_text_index = input_value_index.index(index)
-                text_index = input_value_values[node_input_text_index]
-                if node_input_text_index >= 0 and text_index >= 0:
+            elif (node_name == "input" and index in input_value_of and element_node_value is None):
+                text_index = input_value_of[index]
+                if text_index >= 0:
                     element_node_value = strings[text_index]
 
             # remove redudant elements
@@ -348,8 +517,8 @@ class Crawler:
                 "is_clickable": index in is_clickable,
                 "origin_x": int(x),
                 "origin_y": int(y),
-                "center_x": int(x + (width / 2)),
-                "center_y": int(y + (height / 2)),
+                "center_x": center_x,
+                "center_y": center_y,
             })
 
         # lets filter further to remove anything that does not hold any text nor has click handlers + merge text from leaf#text nodes with the parent
@@ -370,8 +539,8 @@ class Crawler:
             inner_text = f"{node_value} " if node_value else ""
             meta = ""
 
-            if node_index in child_nodes:
-                for child in child_nodes.get(node_index):
+            if int(node_index) in child_nodes:
+                for child in child_nodes.get(int(node_index)):
                     entry_type = child.get('type')
                     entry_value = child.get('value')
 
@@ -400,19 +569,21 @@ class Crawler:
             elif converted_node_name == "button" and meta == "" and inner_text.strip() == "":
                 continue
 
-            page_element_buffer[id_counter] = element
+            element_id = id_counter
+
+            page_element_buffer[element_id] = element
 
             meta = re.sub('\s+', ' ', meta)
             inner_text = re.sub('\s+', ' ', inner_text)
 
             if inner_text != "":
-                elements_of_interest.append(f"""{converted_node_name} {id_counter}{meta} \"{inner_text}\"""")
+                elements_of_interest.append(f"""{converted_node_name} {element_id}{meta} \"{inner_text}\"""")
             elif converted_node_name in ["input", "button"] or "alt" in meta:
-                elements_of_interest.append(f"""{converted_node_name} {id_counter}{meta}""")
+                elements_of_interest.append(f"""{converted_node_name} {element_id}{meta}""")
             elif converted_node_name == "select" and meta != "":
-                elements_of_interest.append(f"""{converted_node_name} {id_counter}{meta}""")
+                elements_of_interest.append(f"""{converted_node_name} {element_id}{meta}""")
             else:
-                # print(f"""{converted_node_name} {id_counter}{meta}""")
+                # print(f"""{converted_node_name} {element_id}{meta}""")
                 pass
             id_counter += 1
 
@@ -440,24 +611,49 @@ class Crawler:
             text += '\n'
             self.type(id, text)
 
-        time.sleep(2)
+        self.settle()
 
 
 class AsyncCrawler(Crawler):
 
-    def __init__(self, playwright) -> None:
+    def __init__(self,
+                 playwright,
+                 vectorized: bool = True,
+                 settle: str = "dom",
+                 settle_timeout: float = 10.,
+                 pool=None) -> None:
+        """
+        Args:
+            pool (BrowserPool, optional): take an isolated context from a pool of warm browsers instead of launching a
+                new browser. See `Crawler.__init__` for the other arguments.
+        """
+        assert settle in SETTLE_STRATEGIES, f"unknown settle strategy {settle}"
         self.playwright = playwright
+        self.pool = pool
+        self.vectorized = vectorized
+        self.settle_strategy = settle
+        self.settle_timeout = settle_timeout
+        self.last_crawl_timings = {}
+        self.last_settle_time = None
 
     async def _init_browser(self):
-        self.browser = await self.playwright.chromium.launch(headless=True,)
-        self.context = await self.browser.new_context(
-            user_agent=
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"
-        )
+        if self.pool is not None:
+            self.context = await self.pool.acquire()
+            self.browser = self.context.browser
+        else:
+            self.browser = await self.playwright.chromium.launch(headless=True,)
+            self.context = await self.browser.new_context(user_agent=USER_AGENT)
 
         self.page = await self.context.new_page()
         await self.page.set_viewport_size({"width": 1280, "height": 1080})
 
+    async def close(self):
+        """Give the browser context back to the pool, or shut down the browser if this crawler launched it."""
+        if self.pool is not None:
+            await self.pool.release(self.context)
+        else:
+            await self.browser.close()
+
     async def screenshot(self):
         _path = "screenshot.png"
         await self.page.screenshot(path=_path)
@@ -467,31 +663,24 @@ class AsyncCrawler(Crawler):
         start = time.time()
 
         page = self.page
-        tree = await self.client.send(
-            "DOMSnapshot.captureSnapshot",
-            {
-                "computedStyles": ["display"],
-                "includeDOMRects": True,
-                "includePaintOrder": True
-            },
-        )
-        device_pixel_ratio = await page.evaluate("window.devicePixelRatio")
-        win_scroll_x = await page.evaluate("window.scrollX")
-        win_scroll_y = await page.evaluate("window.scrollY")
-        win_upper_bound = await page.evaluate("window.pageYOffset")
-        win_left_bound = await page.evaluate("window.pageXOffset")
-        win_width = await page.evaluate("window.screen.width")
-        win_height = await page.evaluate("window.screen.height")
-        elements_of_interest = self._crawl(tree, win_upper_bound, win_width, win_left_bound, win_height,
-                                           device_pixel_ratio)
-
-        print("Parsing time: {:0.2f} seconds".format(time.time() - start))
+
+        # the snapshot and the viewport metrics don't depend on each other, so fetch them concurrently
+        timings = {}
+        tree, metrics = await asyncio.gather(
+            _timed(self.client.send("DOMSnapshot.captureSnapshot", SNAPSHOT_PARAMS), timings, "snapshot"),
+            _timed(page.evaluate(VIEWPORT_METRICS_JS), timings, "metrics"))
+
+        # parsing a large snapshot takes a while, keep it off the event loop so other sessions can make progress
+        elements_of_interest = await asyncio.get_running_loop().run_in_executor(None, self._parse, tree, metrics,
+                                                                                timings)
+
+        self._report_timings(start, timings)
         return elements_of_interest
 
     async def go_to_page(self, url):
         await self.page.goto(url=url if "://" in url else "http://" + url)
         self.client = await self.page.context.new_cdp_session(self.page)
-        self.page_element_buffer = {}
+        self._reset_page_state()
 
     async def scroll(self, direction):
         if direction == "up":
@@ -540,9 +729,36 @@ class AsyncCrawler(Crawler):
     async def enter(self):
         await self.page.keyboard.press("Enter")
 
+    async def settle(self):
+        start = time.time()
+        deadline = start + self.settle_timeout
+
+        if self.settle_strategy == "sleep":
+            await asyncio.sleep(self.settle_timeout)
+
+        while self.settle_strategy != "sleep" and time.time() < deadline:
+            timeout_ms = (deadline - time.time()) * 1000
+            try:
+                if self.settle_strategy == "dom":
+                    await self.page.wait_for_load_state("domcontentloaded", timeout=timeout_ms)
+                    await self.page.evaluate(WAIT_FOR_DOM_QUIET_JS, [DOM_QUIET_MS, timeout_ms])
+                else:
+                    await self.page.wait_for_load_state(self.settle_strategy, timeout=timeout_ms)
+                break
+            except PlaywrightTimeoutError:
+                print("Page did not settle before the timeout")
+                break
+            except PlaywrightError as e:
+                if not _is_navigation_error(e):
+                    raise
+                # the page navigated while we were waiting, wait on the new document instead
+                continue
+
+        return self._report_settle(start)
+
     async def run_cmd(self, cmd):
         print("cmd", cmd)
-        cmd = replace_special_fields(cmd.strip())
+        cmd = await asyncio.get_running_loop().run_in_executor(None, replace_special_fields, cmd.strip())
 
         if cmd.startswith("SCROLL UP"):
             await self.scroll("up")
@@ -564,4 +780,4 @@ class AsyncCrawler(Crawler):
         else:
             raise Exception(f"Invalid command: {cmd}")
 
-        time.sleep(2)
+        await self.settle()
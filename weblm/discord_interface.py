@@ -10,8 +10,10 @@ from discord import Embed, File
 from discord.ext import commands
 from playwright.async_api import async_playwright
 
-from .controller import Command, Controller, Prompt, help_msg
+from .browser_pool import BrowserPool
+from .controllers.basic.controller import Controller
 from .crawler import AsyncCrawler
+from .utils import Command, Prompt, HELP_MSG as help_msg
 
 co = cohere.Client(os.environ.get("COHERE_KEY"))
 
@@ -40,6 +42,7 @@ class MyClient(discord.Client):
         super().__init__(*args, **kwargs)
         self.sessions: Dict[int, Tuple[Crawler, Controller]] = {}
         self.playwright = playwright
+        self.browser_pool = BrowserPool(playwright)
 
     async def on_ready(self):
         """Initializes bot"""
@@ -49,13 +52,20 @@ class MyClient(discord.Client):
             print(f"{self.user} is connected to the following guild:\n"
                   f"{guild.name}(id: {guild.id})")
 
+        await self.browser_pool.warm_up()
+
+    async def end_session(self, id):
+        crawler, _ = self.sessions.pop(id)
+        await crawler.close()
+        print(f"Browser pool: {self.browser_pool.stats()}")
+
     async def find_session(self, id, message):
         print(message.clean_content)
         objective = message.clean_content.removeprefix("weblm ")
 
         if id not in self.sessions:
             print("did not find session")
-            crawler, controller = (AsyncCrawler(self.playwright), Controller(co, objective))
+            crawler, controller = (AsyncCrawler(self.playwright, pool=self.browser_pool), Controller(co, objective))
             await crawler._init_browser()
             print("browser inited")
             self.sessions[id] = (crawler, controller)
@@ -72,15 +82,15 @@ class MyClient(discord.Client):
         crawler, controller = await self.find_session(message.id, message)
 
         if objective == "cancel":
-            del self.sessions[message.id]
+            await self.end_session(message.id)
             return
         elif objective == "help":
             msg = await message.channel.send(help_msg)
             await msg.edit(suppress=True)
             return
         elif objective == "success":
-            controller.success()
-            del self.sessions[message.channel.starter_message.id]
+            await controller.asuccess()
+            await self.end_session(message.channel.starter_message.id)
             msg = await message.channel.send("🎉🎉🎉")
             await msg.edit(suppress=True)
             return
@@ -91,9 +101,9 @@ class MyClient(discord.Client):
             async with message.channel.typing():
                 if not controller.is_running():
                     print("Controller not yet running")
-                    response = controller.step(crawler.page.url, content)
+                    response = await controller.astep(crawler.page.url, content)
                 else:
-                    response = controller.step(crawler.page.url, content, response=objective)
+                    response = await controller.astep(crawler.page.url, content, response=objective)
 
                 print(response)
 
@@ -118,11 +128,11 @@ class MyClient(discord.Client):
         crawler, controller = await self.find_session(message.channel.starter_message.id, message)
 
         if objective == "cancel":
-            del self.sessions[message.channel.starter_message.id]
+            await self.end_session(message.channel.starter_message.id)
             return
         elif objective == "success":
-            controller.success()
-            del self.sessions[message.channel.starter_message.id]
+            await controller.asuccess()
+            await self.end_session(message.channel.starter_message.id)
             msg = await message.channel.send("🎉🎉🎉")
             await msg.edit(suppress=True)
             return
@@ -142,9 +152,9 @@ class MyClient(discord.Client):
             async with message.channel.typing():
                 if not controller.is_running():
                     print("Controller not yet running")
-                    response = controller.step(crawler.page.url, content)
+                    response = await controller.astep(crawler.page.url, content)
                 else:
-                    response = controller.step(crawler.page.url, content, response=objective)
+                    response = await controller.astep(crawler.page.url, content, response=objective)
 
                 print(response)
 
@@ -163,11 +173,11 @@ class MyClient(discord.Client):
         crawler, controller = await self.find_session(message.author.id, message)
 
         if objective == "cancel":
-            del self.sessions[message.author.id]
+            await self.end_session(message.author.id)
             return
         elif objective == "success":
-            controller.success()
-            del self.sessions[message.author.id]
+            await controller.asuccess()
+            await self.end_session(message.author.id)
             msg = await message.channel.send("🎉🎉🎉")
             await msg.edit(suppress=True)
             return
@@ -187,9 +197,9 @@ class MyClient(discord.Client):
             async with message.channel.typing():
                 if not controller.is_running():
                     print("Controller not yet running")
-                    response = controller.step(crawler.page.url, content)
+                    response = await controller.astep(crawler.page.url, content)
                 else:
-                    response = controller.step(crawler.page.url, content, response=objective)
+                    response = await controller.astep(crawler.page.url, content, response=objective)
 
                 print(response)
 
@@ -1,31 +1,34 @@
-"""Search the examples.json file and delete any bad entries."""
+"""Search the example store and delete any bad entries."""
 
-import json
 import os
 import re
 
 import cohere
+import fire
 import numpy as np
 
+from weblm.example_store import get_example_store
+
 co = cohere.Client(os.environ.get("COHERE_KEY"))
 
 
-def search_history(query, history):
-    embeds = [h["embedding"] for h in history]
+def search_history(query, store):
+    embedded_state = store.embed(co, [query])[0]
+    scores, history = store.search(embedded_state)
     examples = [h["example"] for h in history]
-    embeds = np.array(embeds)
-    embedded_state = np.array(co.embed(texts=[query], truncate="RIGHT").embeddings[0])
-    scores = np.einsum("i,ji->j", embedded_state,
-                       embeds) / (np.linalg.norm(embedded_state) * np.linalg.norm(embeds, axis=1))
     ind = np.argsort(scores)
     return np.array(examples)[ind], ind
 
 
-if __name__ == "__main__":
-    with open("examples.json", "r") as fd:
-        history = json.load(fd)
+def main(reembed: bool = False, model: str = None):
+    """Backfill missing objectives, optionally re-embedding every example (e.g. after changing the embedding model).
 
-    indices_for_deletion = []
+    Args:
+        reembed (bool): embed every example again rather than keeping the stored embeddings
+        model (str, optional): the embedding model to re-embed with, queries are embedded with it from then on
+    """
+    store = get_example_store()
+    history = store.records
 
     for h in history:
         if "objective" not in h:
@@ -38,6 +41,11 @@ if __name__ == "__main__":
                 objective = match.group(1)
                 h["objective"] = objective
 
-    with open("examples_tmp.json", "w") as fd:
-        json.dump(history, fd)
-    os.replace("examples_tmp.json", "examples.json")
+    if reembed:
+        store.reembed(co, history, model=model)
+    else:
+        store.rewrite(history, store.embeddings())
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,181 @@
+"""A persistent cache of text embeddings.
+
+Embeddings are keyed by a hash of (model, truncation, text) and stored as float32 blobs in a small sqlite database,
+with an in-memory LRU in front of it. Texts missing from both are embedded in chunks of `EMBED_CHUNK_SIZE` texts, each
+retried on transient errors (see controllers/basic/retry.py). The cohere client splits a chunk into batches the API
+accepts and sends them in parallel.
+"""
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import cohere
+import numpy as np
+
+CACHE_PATH = "embeddings_cache.sqlite"
+# texts per retried embed call, bounds how much work a transient error throws away when embedding a whole store
+EMBED_CHUNK_SIZE = 1024
+
+
+class EmbeddingCache:
+
+    def __init__(self, path: str = CACHE_PATH, max_memory_entries: int = 20_000, max_disk_entries: int = 1_000_000):
+        """
+        Args:
+            path (str): the sqlite file to persist embeddings in, ":memory:" to keep them in memory only
+            max_memory_entries (int): size of the in-memory LRU
+            max_disk_entries (int): the most embeddings to keep on disk, least recently used ones are evicted first
+        """
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._db.commit()
+        (self._disk_entries,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def key(text: str, model: Optional[str], truncate: Optional[str]) -> str:
+        return hashlib.sha256(f"{model}\0{truncate}\0{text}".encode()).hexdigest()
+
+    def embed(self,
+              co: cohere.Client,
+              texts: List[str],
+              model: Optional[str] = None,
+              truncate: Optional[str] = "RIGHT",
+              refresh: bool = False) -> np.ndarray:
+        """Returns a (len(texts), dim) float32 array of embeddings, only requesting the ones that aren't cached.
+
+        With `refresh`, every text is embedded again and replaces its cached embedding.
+        """
+        keys = [self.key(text, model, truncate) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+
+        with self._lock:
+            for key in ([] if refresh else keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.metrics["memory_hits"] += 1
+
+            if not refresh:
+                missing = list(OrderedDict.fromkeys(k for k in keys if k not in found))
+                found.update(self._load(missing))
+
+        missing = [(key, text) for key, text in OrderedDict(zip(keys, texts)).items() if key not in found]
+        if missing:
+            embeddings = self._embed_chunks(co, [text for _, text in missing], model, truncate)
+
+            with self._lock:
+                self.metrics["misses"] += len(missing)
+                new = {key: vector for (key, _), vector in zip(missing, embeddings)}
+                found.update(new)
+                self._store(new, replace=refresh)
+
+        with self._lock:
+            for key in keys:
+                self._remember(key, found[key])
+
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    def _embed_chunks(self, co: cohere.Client, texts: List[str], model: Optional[str],
+                      truncate: Optional[str]) -> np.ndarray:
+        # imported here, the controllers package imports this module
+        from weblm.controllers.basic.retry import call_with_retry
+
+        def _embed(chunk):
+            kwargs = {"texts": chunk}
+            if model is not None:
+                kwargs["model"] = model
+            if truncate is not None:
+                kwargs["truncate"] = truncate
+            # read the embeddings inside the retried call, so errors surfacing on access are retried too
+            return np.asarray(co.embed(**kwargs).embeddings, dtype=np.float32)
+
+        return np.concatenate(
+            [call_with_retry(_embed, texts[i:i + EMBED_CHUNK_SIZE]) for i in range(0, len(texts), EMBED_CHUNK_SIZE)])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.metrics, "memory_entries": len(self._memory), "disk_entries": self._disk_entries}
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        # sqlite limits the number of bound parameters, so look keys up in chunks
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                                    chunk).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            self._db.commit()
+            self.metrics["disk_hits"] += len(found)
+
+        return found
+
+    def _store(self, vectors: Dict[str, np.ndarray], replace: bool = False):
+        now = time.time()
+        if replace:
+            cursor = self._db.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key in vectors])
+            self._disk_entries -= max(cursor.rowcount, 0)
+
+        # another thread or process may have stored the same embedding already, only count rows actually added
+        cursor = self._db.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                                      [(key, vector.astype(np.float32).tobytes(), now)
+                                       for key, vector in vectors.items()])
+
+        self._disk_entries += max(cursor.rowcount, 0)
+        if self._disk_entries > self.max_disk_entries:
+            # other processes sharing the file change the count too, evict based on the real one
+            (self._disk_entries,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if self._disk_entries > self.max_disk_entries:
+            excess = self._disk_entries - self.max_disk_entries
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+            self._disk_entries -= excess
+            self.metrics["evictions"] += excess
+
+        self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+    return _cache
+
+
+def embed(co: cohere.Client,
+          texts: List[str],
+          model: Optional[str] = None,
+          truncate: Optional[str] = "RIGHT",
+          refresh: bool = False) -> np.ndarray:
+    """Embed `texts` through the process-wide cache."""
+    return get_embedding_cache().embed(co, texts, model=model, truncate=truncate, refresh=refresh)
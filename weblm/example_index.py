@@ -0,0 +1,178 @@
+"""Nearest-neighbour indexes over the rows of an example store.
+
+An index never owns the vectors, it is handed the store's memory-mapped matrix, norms and a mask of the rows that
+haven't been deleted on every call, so inserts and deletes in the store are visible to it without a rebuild.
+
+`BruteForceIndex` scores every row exactly. `IVFIndex` is an inverted file index: rows are clustered around
+centroids with spherical k-means and a query only scores the rows in the `nprobe` clusters closest to it. It falls back
+to brute force below `min_rows`, where exact search is already fast.
+"""
+
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+# rows scored per matrix product when training or assigning, bounds the temporary memory used
+CHUNK_SIZE = 8192
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the `k` largest scores, highest first."""
+    if k < len(scores):
+        ind = np.argpartition(scores, -k)[-k:]
+    else:
+        ind = np.arange(len(scores))
+    return ind[np.argsort(scores[ind])[::-1]]
+
+
+def _cosine(vectors: np.ndarray, norms: np.ndarray, query: np.ndarray) -> np.ndarray:
+    return (np.asarray(vectors, dtype=np.float32) @ query) / (norms * np.linalg.norm(query))
+
+
+class BruteForceIndex:
+    """Exact search over every row."""
+
+    def reset(self):
+        pass
+
+    def update(self, vectors: np.ndarray, norms: np.ndarray):
+        pass
+
+    def search(self, query: np.ndarray, k: int, vectors: np.ndarray, norms: np.ndarray,
+               alive: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the scores and row numbers of the `k` live rows most similar to `query`, most similar first."""
+        scores = _cosine(vectors, norms, query)
+        scores[~alive] = -np.inf
+        rows = top_k(scores, min(k, int(alive.sum())))
+        return scores[rows], rows
+
+
+class IVFIndex:
+    """An inverted file index, trained lazily on first search and extended as rows are appended."""
+
+    def __init__(self,
+                 min_rows: int = 10_000,
+                 nprobe: int = 16,
+                 iterations: int = 8,
+                 sample_size: int = 32_768,
+                 retrain_growth: float = 2.,
+                 seed: int = 0):
+        """
+        Args:
+            min_rows (int): below this many rows searches are exact and nothing is trained
+            nprobe (int): the number of clusters scored per query, trading latency for recall
+            iterations (int): k-means iterations when training
+            sample_size (int): the most rows k-means is trained on
+            retrain_growth (float): retrain once the store has grown by this factor since the last training
+            seed (int): seed for sampling rows and initial centroids
+        """
+        self.min_rows = min_rows
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.retrain_growth = retrain_growth
+        self.seed = seed
+
+        self._lock = threading.Lock()
+        self._brute_force = BruteForceIndex()
+        self.reset()
+
+    def reset(self):
+        """Forget the clustering, e.g. when the store's rows are renumbered by a compaction."""
+        self.centroids: Optional[np.ndarray] = None
+        self._lists = []
+        self._indexed = 0
+        self._trained_rows = 0
+
+    def update(self, vectors: np.ndarray, norms: np.ndarray):
+        """Assign rows appended since the last call to their clusters."""
+        with self._lock:
+            if self.centroids is None:
+                return
+
+            if len(vectors) > self.retrain_growth * self._trained_rows:
+                self._train(vectors, norms)
+            elif len(vectors) > self._indexed:
+                self._assign(vectors, norms, self._indexed)
+
+    def search(self, query: np.ndarray, k: int, vectors: np.ndarray, norms: np.ndarray,
+               alive: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the scores and row numbers of (approximately) the `k` live rows most similar to `query`."""
+        if len(vectors) < self.min_rows:
+            return self._brute_force.search(query, k, vectors, norms, alive)
+
+        if self.centroids is None:
+            with self._lock:
+                if self.centroids is None:
+                    self._train(vectors, norms)
+        self.update(vectors, norms)
+
+        with self._lock:
+            centroids, lists = self.centroids, self._lists
+
+        probe = top_k(centroids @ query, min(self.nprobe, len(centroids)))
+        rows = np.concatenate([lists[c] for c in probe])
+        # the lists may already hold rows appended after the caller took its view of the store
+        rows = rows[rows < len(alive)]
+        # sorted so the rows are read from the mapped matrix in file order
+        rows = np.sort(rows[alive[rows]])
+        if len(rows) < k:
+            # too few candidates in the probed clusters, e.g. after many deletes
+            return self._brute_force.search(query, k, vectors, norms, alive)
+
+        scores = _cosine(vectors[rows], norms[rows], query)
+        best = top_k(scores, k)
+        return scores[best], rows[best]
+
+    def _normalized(self, vectors: np.ndarray, norms: np.ndarray, start: int, end: int) -> np.ndarray:
+        return np.asarray(vectors[start:end], dtype=np.float32) / np.maximum(norms[start:end, None], 1e-12)
+
+    def _train(self, vectors: np.ndarray, norms: np.ndarray):
+        count = len(vectors)
+        rng = np.random.default_rng(self.seed)
+        num_lists = max(1, int(np.sqrt(count)))
+
+        sample = np.sort(rng.choice(count, size=min(count, self.sample_size), replace=False))
+        sample = np.asarray(vectors[sample], dtype=np.float32) / np.maximum(norms[sample, None], 1e-12)
+        centroids = sample[rng.choice(len(sample), size=num_lists, replace=False)]
+
+        for _ in range(self.iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            # clusters that lost all their rows are restarted from a random row
+            empty = np.bincount(assignments, minlength=num_lists) == 0
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        self.centroids = centroids
+        self._lists = [np.zeros((0,), dtype=np.int64) for _ in range(num_lists)]
+        self._indexed = 0
+        self._trained_rows = count
+        self._assign(vectors, norms, 0)
+        print(f"Trained an IVF index with {num_lists} lists on {count} examples, searches probing {self.nprobe} of "
+              "them are approximate (see benchmarks/example_index.py)")
+
+    def _assign(self, vectors: np.ndarray, norms: np.ndarray, start: int):
+        count = len(vectors)
+        assignments = np.concatenate([
+            np.argmax(self._normalized(vectors, norms, i, min(i + CHUNK_SIZE, count)) @ self.centroids.T, axis=1)
+            for i in range(start, count, CHUNK_SIZE)
+        ])
+
+        rows = np.arange(start, count, dtype=np.int64)
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        # build new lists rather than appending in place, so concurrent searches see either the old or the new ones
+        self._lists = [
+            np.concatenate([rows_, rows[order[bounds[c]:bounds[c + 1]]]]) if bounds[c + 1] > bounds[c] else rows_
+            for c, rows_ in enumerate(self._lists)
+        ]
+        self._indexed = count
+
+
+INDEXES = {
+    "brute": BruteForceIndex,
+    "ivf": IVFIndex,
+}
@@ -0,0 +1,478 @@
+"""A binary store for saved examples and their embeddings.
+
+Embeddings live in one contiguous, memory-mapped float32 (or float16) matrix next to their precomputed norms, and the
+rest of each example lives in a JSON-lines file of records. Looking up the most similar examples is a single
+matrix-vector product over the mapped matrix, with no parsing.
+
+The files of a generation are only ever appended to. New examples are appended to the vectors and norms first and to
+the records last, so a row only exists once its record line is complete, and anything a crash leaves past the last
+complete record is truncated before the next append. Deletions are appended to a tombstone log, and the store is
+compacted into a new generation once enough rows are deleted.
+
+Layout of a store directory:
+    store.json              {"dim", "dtype", "generation", "model"}, replaced atomically to switch generations
+    vectors.<gen>.bin       row-major (count, dim) matrix of embeddings
+    norms.<gen>.bin         (count,) float32 norms of the rows above
+    records.<gen>.jsonl     one record per row, without its embedding
+    deleted.<gen>.jsonl     indices of deleted rows
+    store.lock              flock'ed by writers, so processes sharing the store take turns appending and rewriting
+
+To migrate an existing examples.json, or to compact a store by hand:
+    python -m weblm.example_store migrate examples.json examples
+    python -m weblm.example_store compact examples
+
+"model" is the embedding model the examples were embedded with (null for the API's default). Queries are embedded
+with the same model through `ExampleStore.embed`, so changing models only takes re-embedding the store (see
+`ExampleStore.reembed`).
+
+Nearest-neighbour lookups go through a pluggable index (see example_index.py), exact by default and an inverted file
+index for large stores.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from weblm.embedding_cache import embed
+from weblm.example_index import INDEXES
+
+EXAMPLES_PATH = "examples"
+LEGACY_EXAMPLES_PATH = "examples.json"
+# compact once this fraction of the rows are deleted
+COMPACT_RATIO = 0.25
+# "brute" for exact search, "ivf" for approximate search that only becomes approximate past IVFIndex.min_rows
+DEFAULT_INDEX = "ivf"
+
+
+def example_hash(example: str) -> str:
+    return hashlib.sha256(example.encode()).hexdigest()
+
+
+class _View(NamedTuple):
+    records: List[Dict[str, Any]]  # records of the live rows
+    live: np.ndarray  # row numbers of the live rows
+    vectors: np.ndarray
+    norms: np.ndarray
+    alive: np.ndarray  # mask over all rows, False for deleted ones
+    rows: List[Dict[str, Any]]  # records of all rows
+    masks: Dict[Callable, np.ndarray]  # cached `mask`s of this generation, shared by the views that follow it
+
+
+class ExampleStore:
+
+    def __init__(self, path: str = EXAMPLES_PATH, index: str = DEFAULT_INDEX):
+        """
+        Args:
+            path (str): the store directory
+            index (str): the nearest-neighbour index to use, one of example_index.INDEXES
+        """
+        self.path = path
+        self.index = INDEXES[index]()
+        self.generation = None
+        self._stamp = None
+        self._lock = threading.RLock()
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def records(self) -> List[Dict[str, Any]]:
+        """The records of the rows that haven't been deleted, in row order."""
+        return self._view.records
+
+    def _file(self, name: str, generation: int = None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.path, name.format(generation))
+
+    def _read_stamp(self):
+        try:
+            index = os.stat(os.path.join(self.path, "store.json"))
+            records = os.stat(self._file("records.{}.jsonl"))
+        except (FileNotFoundError, AttributeError):
+            return None
+
+        try:
+            deleted = os.stat(self._file("deleted.{}.jsonl")).st_size
+        except FileNotFoundError:
+            deleted = 0
+        return (index.st_mtime_ns, records.st_mtime_ns, records.st_size, deleted)
+
+    def is_stale(self) -> bool:
+        return self._read_stamp() != self._stamp
+
+    def reload(self):
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        index_path = os.path.join(self.path, "store.json")
+        previous_generation = self.generation
+        self._rows: List[Dict[str, Any]] = []
+        self._deleted = set()
+        self._hashes = set()
+        self._records_size = 0
+        self._deleted_size = 0
+        self._masks: Dict[Callable, np.ndarray] = {}
+
+        if not os.path.exists(index_path):
+            self.dim, self.dtype, self.generation, self.model = 0, np.dtype(np.float32), -1, None
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._norms = np.zeros((0,), dtype=np.float32)
+            self._stamp = None
+            self._update_view()
+            return
+
+        with open(index_path, "r") as fd:
+            index = json.load(fd)
+        self.dim, self.dtype, self.generation = index["dim"], np.dtype(index["dtype"]), index["generation"]
+        self.model = index.get("model")
+        if self.generation != previous_generation:
+            # rows are renumbered in a new generation
+            self.index.reset()
+
+        # a line without its newline is an append that didn't finish, the row doesn't exist yet
+        for line in _complete_lines(self._file("records.{}.jsonl")):
+            self._rows.append(json.loads(line))
+            self._records_size += len(line)
+
+        for line in _complete_lines(self._file("deleted.{}.jsonl")):
+            self._deleted.add(int(line))
+            self._deleted_size += len(line)
+
+        count = len(self._rows)
+        self._vectors = _map(self._file("vectors.{}.bin"), self.dtype, (count, self.dim))
+        self._norms = _map(self._file("norms.{}.bin"), np.float32, (count,))
+        self._hashes = {example_hash(r["example"]) for i, r in enumerate(self._rows) if i not in self._deleted}
+        self._stamp = self._read_stamp()
+        self._update_view()
+
+    def _update_view(self):
+        alive = np.ones(len(self._rows), dtype=bool)
+        alive[list(self._deleted)] = False
+        live = np.flatnonzero(alive)
+        # swapped in as one tuple so concurrent searches never mix rows from before and after a change
+        self._view = _View([self._rows[i] for i in live], live, self._vectors, self._norms, alive, list(self._rows),
+                           self._masks)
+
+    def embed(self, co, texts: List[str], truncate: Optional[str] = "RIGHT") -> np.ndarray:
+        """Embed `texts` with the model the stored examples were embedded with, so they can be compared."""
+        return embed(co, texts, model=self.model, truncate=truncate)
+
+    def contains(self, example: str) -> bool:
+        return example_hash(example) in self._hashes
+
+    def search(self, query: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """Cosine similarity of `query` to every stored example, along with the records the scores refer to."""
+        view = self._view
+        if len(view.records) == 0:
+            return np.zeros((0,), dtype=np.float32), view.records
+
+        query = np.asarray(query, dtype=np.float32)
+        scores = (view.vectors @ query) / (view.norms * np.linalg.norm(query))
+        return scores if len(view.live) == len(scores) else scores[view.live], view.records
+
+    def mask(self, predicate: Callable[[Dict[str, Any]], bool]) -> np.ndarray:
+        """A boolean mask over all rows of the records `predicate` accepts.
+
+        Masks are cached per predicate and only evaluated on rows appended since they were last used.
+        """
+        return self._mask(self._view, predicate)
+
+    def _mask(self, view: _View, predicate: Callable[[Dict[str, Any]], bool]) -> np.ndarray:
+        with self._lock:
+            mask = view.masks.get(predicate, np.zeros((0,), dtype=bool))
+            if len(mask) < len(view.rows):
+                new = np.fromiter((predicate(r) for r in view.rows[len(mask):]),
+                                  dtype=bool,
+                                  count=len(view.rows) - len(mask))
+                mask = view.masks[predicate] = np.concatenate([mask, new])
+            return mask[:len(view.rows)]
+
+    def nearest(self,
+                query: np.ndarray,
+                k: int,
+                where: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """The (at most) `k` examples most similar to `query` according to the index, most similar first.
+
+        Args:
+            query (np.ndarray): the embedding to search for
+            k (int): the number of examples to return
+            where (Callable, optional): only consider records this predicate accepts, see `mask`
+        """
+        view = self._view
+        valid = view.alive if where is None else view.alive & self._mask(view, where)
+        if not valid.any():
+            return np.zeros((0,), dtype=np.float32), []
+
+        query = np.asarray(query, dtype=np.float32)
+        scores, found = self.index.search(query, k, view.vectors, view.norms, valid)
+        return scores, [view.rows[i] for i in found]
+
+    def embeddings(self) -> np.ndarray:
+        view = self._view
+        return np.asarray(view.vectors[view.live], dtype=np.float32)
+
+    def rewrite(self,
+                records: Sequence[Dict[str, Any]],
+                embeddings: np.ndarray,
+                dtype: Optional[str] = None,
+                model: Optional[str] = None):
+        """Atomically replace the store's contents with `records` and their `embeddings` (made with `model`, defaults
+        to the store's current model)."""
+        with self._lock, _locked(self.path):
+            if self.is_stale():
+                self._reload()
+            self._rewrite(records, embeddings, dtype=dtype, model=model)
+
+    def _rewrite(self,
+                 records: Sequence[Dict[str, Any]],
+                 embeddings: np.ndarray,
+                 dtype: Optional[str] = None,
+                 model: Optional[str] = None):
+        write_store(self.path,
+                    records,
+                    embeddings,
+                    dtype=dtype or self.dtype.name,
+                    generation=self.generation + 1,
+                    model=model or self.model)
+        self._reload()
+
+    def compact(self):
+        """Rewrite the store without its deleted rows."""
+        with self._lock, _locked(self.path):
+            if self.is_stale():
+                self._reload()
+            self._rewrite(self.records, self.embeddings())
+
+    def add(self, record: Dict[str, Any], embedding: Sequence[float]) -> bool:
+        """Add one example, returns False if an identical example is already stored."""
+        return self.add_many([record], [embedding]) == 1
+
+    def add_many(self, records: Sequence[Dict[str, Any]], embeddings: np.ndarray) -> int:
+        """Append examples in a single write, skipping ones that are already stored. Returns the number added."""
+        with self._lock, _locked(self.path):
+            if self.is_stale():
+                self._reload()
+
+            new, hashes = [], set()
+            for record, embedding in zip(records, np.asarray(embeddings, dtype=np.float32)):
+                h = example_hash(record["example"])
+                if h not in self._hashes and h not in hashes:
+                    new.append((record, embedding))
+                    hashes.add(h)
+
+            if not new:
+                return 0
+
+            records = [record for record, _ in new]
+            embeddings = np.stack([embedding for _, embedding in new])
+            if self.generation < 0 or self.dim == 0 or not self._rows:
+                # nothing to append to (e.g. migrated from an empty examples.json), the new rows set the dimension
+                self._rewrite(records, embeddings)
+                return len(records)
+
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(f"embeddings have dimension {embeddings.shape[1]}, the store has {self.dim}")
+
+            vectors = embeddings.astype(self.dtype)
+            norms = np.linalg.norm(vectors.astype(np.float32), axis=1).astype(np.float32)
+            data = "".join(json.dumps(r) + "\n" for r in records).encode()
+
+            # drop whatever an interrupted append left behind, then write the record lines last so a row only appears
+            # once its vector and norm are on disk
+            count = len(self._rows)
+            _append(self._file("vectors.{}.bin"), count * self.dim * self.dtype.itemsize, vectors.tobytes())
+            _append(self._file("norms.{}.bin"), count * 4, norms.tobytes())
+            _append(self._file("records.{}.jsonl"), self._records_size, data)
+
+            self._rows.extend(records)
+            self._records_size += len(data)
+            self._hashes.update(hashes)
+            self._vectors = _map(self._file("vectors.{}.bin"), self.dtype, (len(self._rows), self.dim))
+            self._norms = _map(self._file("norms.{}.bin"), np.float32, (len(self._rows),))
+            self._stamp = self._read_stamp()
+            self._update_view()
+            self.index.update(self._vectors, self._norms)
+            return len(records)
+
+    def ingest(self, co, records: Sequence[Dict[str, Any]]) -> int:
+        """Embed and add many examples at once, skipping ones that are already stored. Returns the number added.
+
+        The new examples are embedded with the store's model in as few requests as the API allows and appended in a
+        single write.
+        """
+        new, seen = [], set()
+        for record in records:
+            if not self.contains(record["example"]) and record["example"] not in seen:
+                new.append(record)
+                seen.add(record["example"])
+
+        if not new:
+            return 0
+
+        return self.add_many(new, self.embed(co, [r["example"] for r in new], truncate=None))
+
+    def reembed(self, co, records: Optional[Sequence[Dict[str, Any]]] = None, model: Optional[str] = None):
+        """Embed every example again, bypassing the embedding cache, and replace the store's embeddings, e.g. after
+        changing the embedding model.
+
+        Args:
+            co (cohere.Client): a Cohere Client
+            records (Sequence[Dict[str, Any]], optional): the records to store, defaults to the current ones
+            model (str, optional): the embedding model to switch to, defaults to the store's current one
+        """
+        records = self.records if records is None else records
+        model = model or self.model
+        embeddings = embed(co, [r["example"] for r in records], model=model, truncate=None, refresh=True)
+        self.rewrite(records, embeddings, model=model)
+
+    def delete(self, indices: Sequence[int]):
+        """Delete examples by their position in `records`, compacting the store if enough rows are gone."""
+        with self._lock, _locked(self.path):
+            # the positions refer to the records the caller last saw, another writer may have changed the store since
+            hashes = {example_hash(self._view.records[i]["example"]) for i in indices}
+            if self.is_stale():
+                self._reload()
+
+            view = self._view
+            rows = sorted(int(row) for row, r in zip(view.live, view.records) if example_hash(r["example"]) in hashes)
+            if not rows:
+                return
+
+            data = "".join(f"{row}\n" for row in rows).encode()
+            _append(self._file("deleted.{}.jsonl"), self._deleted_size, data)
+
+            self._deleted.update(rows)
+            self._deleted_size += len(data)
+            self._hashes -= {example_hash(self._rows[row]["example"]) for row in rows}
+            self._stamp = self._read_stamp()
+            self._update_view()
+
+            if len(self._deleted) > COMPACT_RATIO * len(self._rows):
+                self._rewrite(self.records, self.embeddings())
+
+
+@contextmanager
+def _locked(path: str):
+    """Hold the store's lock file for the duration, against writers in other processes. Not reentrant."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "store.lock"), "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _complete_lines(path: str) -> List[bytes]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as fd:
+        return [line for line in fd if line.endswith(b"\n")]
+
+
+def _append(path: str, valid_size: int, data: bytes):
+    with open(path, "ab") as fd:
+        fd.truncate(valid_size)
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def _map(path: str, dtype, shape) -> np.ndarray:
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def write_store(path: str,
+                records: Sequence[Dict[str, Any]],
+                embeddings: np.ndarray,
+                dtype: str = "float32",
+                generation: int = 0,
+                model: Optional[str] = None):
+    """Write a new generation of the store at `path` and switch to it once all of its files are on disk."""
+    os.makedirs(path, exist_ok=True)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings = embeddings.reshape(len(records), -1) if len(records) else np.zeros((0, 0), dtype=np.float32)
+    vectors = embeddings.astype(dtype)
+    norms = np.linalg.norm(vectors.astype(np.float32), axis=1).astype(np.float32)
+
+    def _write(name, write):
+        with open(os.path.join(path, name.format(generation)), "wb") as fd:
+            write(fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    _write("vectors.{}.bin", lambda fd: fd.write(np.ascontiguousarray(vectors).tobytes()))
+    _write("norms.{}.bin", lambda fd: fd.write(norms.tobytes()))
+    _write("records.{}.jsonl",
+           lambda fd: fd.write("".join(json.dumps(r) + "\n" for r in records).encode()))
+
+    index = {
+        "dim": int(embeddings.shape[1]) if len(records) else 0,
+        "dtype": np.dtype(dtype).name,
+        "generation": generation,
+        "model": model,
+    }
+    with open(os.path.join(path, "store.json.tmp"), "w") as fd:
+        json.dump(index, fd)
+    os.replace(os.path.join(path, "store.json.tmp"), os.path.join(path, "store.json"))
+
+    for name in os.listdir(path):
+        parts = name.split(".")
+        if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) != generation:
+            os.remove(os.path.join(path, name))
+
+
+def migrate(examples_json: str = LEGACY_EXAMPLES_PATH,
+            path: str = EXAMPLES_PATH,
+            dtype: str = "float32",
+            model: Optional[str] = None):
+    """One-time conversion of an examples.json file, embedded with `model`, into a binary store."""
+    with open(examples_json, "r") as fd:
+        history = json.load(fd)
+
+    embeddings = np.array([h["embedding"] for h in history], dtype=np.float32)
+    records = [{k: v for k, v in h.items() if k != "embedding"} for h in history]
+    with _locked(path):
+        write_store(path, records, embeddings, dtype=dtype, model=model)
+    print(f"Migrated {len(records)} examples from {examples_json} to {path}")
+
+
+def compact(path: str = EXAMPLES_PATH):
+    store = ExampleStore(path)
+    store.compact()
+    print(f"Compacted {path} to {len(store)} examples")
+
+
+_stores: Dict[str, ExampleStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_example_store(path: str = EXAMPLES_PATH) -> ExampleStore:
+    """A cached store, reloaded when another writer has changed it. Migrates examples.json on first use."""
+    with _stores_lock:
+        if not os.path.exists(os.path.join(path, "store.json")) and os.path.exists(LEGACY_EXAMPLES_PATH):
+            migrate(LEGACY_EXAMPLES_PATH, path)
+
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ExampleStore(path)
+        elif store.is_stale():
+            store.reload()
+
+        return store
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire({"migrate": migrate, "compact": compact})
@@ -1,28 +1,25 @@
-"""Search the examples.json file and delete any bad entries."""
+"""Search the example store and delete any bad entries."""
 
-import json
 import os
 
 import cohere
 import numpy as np
 
+from weblm.example_store import get_example_store
+
 co = cohere.Client(os.environ.get("COHERE_KEY"))
 
 
-def search_history(query, history):
-    embeds = [h["embedding"] for h in history]
+def search_history(query, store):
+    embedded_state = store.embed(co, [query])[0]
+    scores, history = store.search(embedded_state)
     examples = [h["example"] for h in history]
-    embeds = np.array(embeds)
-    embedded_state = np.array(co.embed(texts=[query], truncate="RIGHT").embeddings[0])
-    scores = np.einsum("i,ji->j", embedded_state,
-                       embeds) / (np.linalg.norm(embedded_state) * np.linalg.norm(embeds, axis=1))
     ind = np.argsort(scores)
     return np.array(examples)[ind], ind
 
 
 if __name__ == "__main__":
-    with open("examples.json", "r") as fd:
-        history = json.load(fd)
+    store = get_example_store()
 
     indices_for_deletion = []
     s = ""
@@ -30,7 +27,7 @@ if __name__ == "__main__":
     try:
         while True:
             s = input("Search: ")
-            examples, ind = search_history(s, history)
+            examples, ind = search_history(s, store)
 
             for ex, i in reversed(list(zip(examples, ind))):
                 print(f"Example:\n{ex}"
@@ -45,9 +42,4 @@ if __name__ == "__main__":
                     raise Exception()
     except Exception as e:
         print(e)
-        for i in sorted(indices_for_deletion, reverse=True):
-            history.pop(i)
-
-        with open("examples_tmp.json", "w") as fd:
-            json.dump(history, fd)
-        os.replace("examples_tmp.json", "examples.json")
+        store.delete(indices_for_deletion)
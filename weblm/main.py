@@ -7,7 +7,6 @@
 
 import os
 import re
-import time
 from multiprocessing import Pool
 
 import cohere
@@ -20,8 +19,8 @@ from .utils import Prompt, Command
 co = cohere.Client(os.environ.get("COHERE_KEY"), check_api_key=False)
 
 
-def reset(controller):
-    _crawler = Crawler()
+def reset(controller, settle="dom", settle_timeout=10.):
+    _crawler = Crawler(settle=settle, settle_timeout=settle_timeout)
 
     def print_help():
         print("(g) to visit url\n(u) scroll up\n(d) scroll dow\n(c) to click\n(t) to type\n" +
@@ -37,8 +36,8 @@ def reset(controller):
     return _crawler, _controller
 
 
-def main(controller="basic"):
-    crawler, controller = reset(controller)
+def main(controller="basic", settle="dom", settle_timeout=10.):
+    crawler, controller = reset(controller, settle, settle_timeout)
 
     response = None
     content = []
@@ -60,7 +59,7 @@ def main(controller="basic"):
             url = re.match(URL_PATTERN, response[5:]).group(0)
             response = None
             crawler.go_to_page(url)
-            time.sleep(2)
+            crawler.settle()
 
         content = crawler.crawl()
         while len(content) == 0: